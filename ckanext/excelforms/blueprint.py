@@ -1,40 +1,77 @@
 import re
+import time
 from collections import OrderedDict
+from contextlib import contextmanager
 import simplejson as json
+from six import text_type
 
 from logging import getLogger
 
-from flask import Response, Blueprint
+from flask import Response, Blueprint, abort as flask_abort
 from ckan.plugins.toolkit import (_, config, asbool, aslist, render,
-    request, h, abort, g)
-from ckan.logic import ValidationError, NotAuthorized
+    request, h, abort, g, check_access)
+from ckan.logic import ValidationError, NotAuthorized, NotFound
 
+from ckanext.excelforms.cache import cached_template, fingerprint
+from ckanext.excelforms.choices import get_choice_fields
+from ckanext.excelforms.chunked import chunked_uploads, status as chunked_status
+from ckanext.excelforms.dedupe import upload_results, deduplicated
 from ckanext.excelforms.errors import BadExcelData
-from ckanext.excelforms.read_excel import read_excel, get_records
-from ckanext.excelforms.write_excel import excel_template, append_data
+from ckanext.excelforms.profiling import profiled, profiling
+from ckanext.excelforms.spool import spooled_upload
+from ckanext.excelforms.throttle import (
+    limited, request_slot, concurrency_limited, Busy)
+from ckanext.excelforms.workers import (
+    run_heavy, workers_enabled, WorkerUnavailable)
+
+# openpyxl, ckanapi and the datastore backend are imported by the
+# functions that use them, so that loading this plugin doesn't slow
+# down every CKAN process, e.g. CLI commands and job workers
 
 from io import BytesIO
 
 log = getLogger(__name__)
 
-import ckanapi
-
 excelforms = Blueprint('excelforms', __name__)
 
+DEFAULT_MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+DEFAULT_MAX_UNCOMPRESSED_BYTES = 1024 * 1024 * 1024
+DEFAULT_MAX_ROWS = 1000000
+DEFAULT_MAX_COLUMNS = 1000
+MAX_REPORTED_DUPLICATES = 100
+
+def _local_ckan():
+    import ckanapi
+    return ckanapi.LocalCKAN(username=g.user)
+
 def _get_data_dictionary(lc, resource_id):
+    """
+    Return the datastore fields for resource_id with 'primary_key': True
+    set on the fields of the table's primary key
+    """
+    from ckanext.excelforms.datastore import primary_key_fields
     table = lc.action.datastore_search(
         resource_id=resource_id,
         limit=0,
         include_total=False)
+    pk = primary_key_fields(resource_id)
+    for f in table['fields']:
+        if f['id'] in pk:
+            f['primary_key'] = True
     return table['fields']
 
+
+def _primary_key_fields(dd):
+    return [f['id'] for f in dd if f.get('primary_key')]
+
 @excelforms.route('/dataset/<id>/excelforms/<resource_id>/upload', methods=['POST'])
+@profiled
 def upload(id, resource_id):
     """
     View for downloading Excel templates and
     uploading packages via Excel .xls files
     """
-    lc = ckanapi.LocalCKAN(username=g.user)
+    lc = _local_ckan()
     dd = _get_data_dictionary(lc, resource_id)
     dry_run = 'validate' in request.form
     try:
@@ -63,7 +100,162 @@ def upload(id, resource_id):
     return h.redirect_to('dataset_resource.read', id=id, resource_id=resource_id)
 
 
+@excelforms.route('/dataset/<id>/excelforms/<resource_id>/upload.json', methods=['POST'])
+@profiled
+def upload_api(id, resource_id):
+    """
+    API for loading records from an excel template, CSV/TSV or NDJSON
+    file sent as the request body (or as an xls_update form field).
+    Pass ?dry_run=true to validate without saving.
+
+    Returns a JSON object with record counts, timings and any error,
+    with the row number of the error when it is known.
+    """
+    dry_run = asbool(request.args.get('dry_run', False))
+    lc = _local_ckan()
+
+    def process():
+        dd = _get_data_dictionary(lc, resource_id)
+        upload_file = request.files.get('xls_update')
+        if upload_file:
+            return _process_upload_file(
+                lc, resource_id, upload_file, dd, dry_run)
+        max_bytes = _upload_limits()['max_bytes']
+        if max_bytes and (request.content_length or 0) > max_bytes:
+            raise BadExcelData(
+                _('The file uploaded is too large. The maximum size is '
+                '{0} bytes').format(max_bytes))
+        # NDJSON is streamed line by line, other files are spooled.
+        # Both count bytes as they are read: chunked request bodies
+        # have no Content-Length
+        return _process_upload_file(
+            lc, resource_id, request.stream, dd, dry_run,
+            content_type=request.mimetype, stream=True)
+
+    return _json_result(process)
+
+
+@excelforms.route('/dataset/<id>/excelforms/<resource_id>/chunked', methods=['POST'])
+def chunked_create(id, resource_id):
+    """
+    API for starting a resumable chunked upload. The JSON request body
+    contains the total "size" in bytes and optionally the "filename"
+    and the "sha256" of the whole file.
+    """
+    def create():
+        check_access(
+            'datastore_upsert', {'user': g.user}, {'resource_id': resource_id})
+        data = request.get_json(silent=True) or {}
+        try:
+            size = int(data.get('size', 0))
+        except (TypeError, ValueError):
+            size = 0
+        return chunked_uploads().create(
+            resource_id,
+            g.user,
+            size,
+            data.get('filename'),
+            data.get('sha256'),
+            _upload_limits()['max_bytes'])
+
+    return _json_result(create)
+
+
+@excelforms.route('/dataset/<id>/excelforms/<resource_id>/chunked/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def chunked_upload(id, resource_id, upload_id):
+    """
+    API for a chunked upload: GET returns the byte ranges received so
+    far, PUT stores the request body at ?offset=N checked against an
+    optional X-Chunk-SHA256 header, DELETE abandons the upload
+    """
+    uploads = chunked_uploads()
+
+    def chunk():
+        if request.method == 'PUT':
+            try:
+                offset = int(request.args.get('offset', 0))
+            except ValueError:
+                raise BadExcelData(_('Invalid chunk offset'))
+            return uploads.write(
+                upload_id,
+                resource_id,
+                g.user,
+                offset,
+                request.get_data(),
+                request.headers.get('X-Chunk-SHA256'))
+        meta = uploads.get(upload_id, resource_id, g.user)
+        if request.method == 'DELETE':
+            uploads.remove(upload_id)
+        return chunked_status(meta)
+
+    return _json_result(chunk)
+
+
+@excelforms.route('/dataset/<id>/excelforms/<resource_id>/chunked/<upload_id>/complete', methods=['POST'])
+@profiled
+def chunked_complete(id, resource_id, upload_id):
+    """
+    API for loading a completed chunked upload like upload.json.
+    Pass ?dry_run=true to validate without saving, the upload is kept
+    for a following request without dry_run. Uploads that fail to load
+    are also kept so they can be completed again.
+    """
+    dry_run = asbool(request.args.get('dry_run', False))
+    lc = _local_ckan()
+    uploads = chunked_uploads()
+
+    def process():
+        dd = _get_data_dictionary(lc, resource_id)
+        meta = uploads.get(upload_id, resource_id, g.user)
+        return uploads.complete(
+            upload_id, resource_id, g.user,
+            lambda f: _process_upload_file(
+                lc, resource_id, f, dd, dry_run,
+                filename=meta['filename'], on_disk=True),
+            keep=dry_run)
+
+    return _json_result(process)
+
+
+def _json_result(fn):
+    """
+    Return a JSON API response with the result of fn() or the error
+    it raised
+    """
+    try:
+        result = fn()
+    except NotAuthorized:
+        return _json_response({'success': False, 'error': {
+            '__type': 'Authorization Error',
+            'message': _('Not authorized')}}, 403)
+    except NotFound:
+        return _json_response({'success': False, 'error': {
+            '__type': 'Not Found Error',
+            'message': _('Not found')}}, 404)
+    except Busy as e:
+        response = _json_response({'success': False, 'error': {
+            '__type': 'Too Many Requests',
+            'message': e.message}}, 429)
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    except BadExcelData as e:
+        return _json_response({'success': False, 'error': {
+            '__type': 'Validation Error',
+            'message': e.message,
+            'row': e.row}}, 400)
+
+    return _json_response({'success': True, 'result': result})
+
+
+def _json_response(data, status=200):
+    return Response(
+        json.dumps(data),
+        status=status,
+        content_type='application/json;charset=utf-8')
+
+
 @excelforms.route('/dataset/<id>/excelforms/template-<resource_id>.xlsx', methods=['GET'])
+@profiled
 def template(id, resource_id):
     """
     Generate excel template
@@ -73,49 +265,608 @@ def template(id, resource_id):
         bulk-template -> an array of strings, each string contains primary keys separated by commas
     """
 
-    lc = ckanapi.LocalCKAN(username=g.user)
+    lc = _local_ckan()
     dd = _get_data_dictionary(lc, resource_id)
     resource = lc.action.resource_show(id=resource_id)
 
+    if request.method != 'POST' and not profiling():
+        blob = _cached_template_build(
+            u'{0}-{1}'.format(resource_id, h.lang()),
+            fingerprint(resource, dd),
+            _build_template, resource, dd)
+        return _template_response(blob, resource_id)
+
+    from ckanext.excelforms.write_excel import excel_template, append_data
     book = excel_template(resource, dd)
+    if request.method != 'POST':
+        return _template_response(_template_bytes(book), resource_id)
 
-    if request.method == 'POST':
-        filters = {}
-        primary_keys = request.POST.getall('bulk-template')
+    filters = {}
+    primary_keys = request.POST.getall('bulk-template')
 
-        record_data = []
+    record_data = []
+
+    for keys in primary_keys:
+        temp = keys.split(",")
+        for f, pkf in zip(temp, _primary_key_fields(dd)):
+            filters[pkf] = f
+        try:
+            result = lc.action.datastore_search(resource_id=resource_id,filters = filters)
+        except NotAuthorized:
+            abort(403, _("Not authorized"))
+        record_data += result['records']
+
+    append_data(book, record_data, dd)
+
+    return _template_response(_template_bytes(book), resource_id)
+
+
+@excelforms.route('/dataset/<id>/excelforms/template.xlsx', methods=['GET'])
+@profiled
+def dataset_template(id):
+    """
+    Generate one excel template with a form sheet for each datastore
+    resource in the dataset
+    """
+    lc = _local_ckan()
+    package, resource_dds = _get_dataset_dictionaries(lc, id)
+    resources = [
+        (r, resource_dds[r['id']]) for r in package['resources']
+        if r['id'] in resource_dds]
+
+    if profiling():
+        with _template_build_errors():
+            blob = _run_template_build(
+                _build_dataset_template, package, resources)
+        return _template_response(blob, package['name'])
+    blob = _cached_template_build(
+        u'{0}-{1}'.format(package['id'], h.lang()),
+        fingerprint(package, resources),
+        _build_dataset_template, package, resources)
+    return _template_response(blob, package['name'])
 
-        for keys in primary_keys:
-            temp = keys.split(",")
-            for f, pkf in zip(temp, pk_fields):
-                filters[pkf['datastore_id']] = f
-            try:
-                result = lc.action.datastore_search(resource_id=resource_id,filters = filters)
-            except NotAuthorized:
-                abort(403, _("Not authorized"))
-            record_data += result['records']
 
-        append_data(book, record_data, dd)
+@excelforms.route('/dataset/<id>/excelforms/upload', methods=['POST'])
+@profiled
+def dataset_upload(id):
+    """
+    View for uploading a dataset template with form sheets for
+    multiple resources
+    """
+    lc = _local_ckan()
+    package, resource_dds = _get_dataset_dictionaries(lc, id)
+    dry_run = 'validate' in request.form
+    try:
+        if not request.files.get('xls_update'):
+            raise BadExcelData(_('You must provide a valid file'))
+
+        with spooled_upload(
+                request.files['xls_update'],
+                _upload_limits()['max_bytes']) as (upload_file, sha256):
+            _process_dataset_upload_file(
+                lc,
+                resource_dds,
+                upload_file,
+                dry_run)
+
+        if dry_run:
+            h.flash_success(_(
+                "No errors found."
+                ))
+        else:
+            h.flash_success(_(
+                "Your file was successfully uploaded."
+                ))
+
+    except BadExcelData as e:
+        h.flash_error(e.message)
+
+    return h.redirect_to('dataset.read', id=id)
+
+
+def _get_dataset_dictionaries(lc, id):
+    """
+    Return the package dict and an OrderedDict of {resource_id: dd}
+    for its datastore resources, aborting with 404 when there are none
+    """
+    try:
+        package = lc.action.package_show(id=id)
+    except NotFound:
+        abort(404, _('Dataset not found'))
+    except NotAuthorized:
+        abort(403, _('Not authorized'))
+    resource_dds = OrderedDict(
+        (r['id'], _get_data_dictionary(lc, r['id']))
+        for r in package['resources'] if r.get('datastore_active'))
+    if not resource_dds:
+        abort(404, _('No datastore resources in this dataset'))
+    return package, resource_dds
+
+
+def _cached_template_build(name, key, build, *args):
+    """
+    Return the cached template for name and key, building it with
+    build(*args) if required.
 
+    Busy and WorkerUnavailable are raised for the request that ran the
+    build (its user's request limit, its worker) so requests waiting on
+    the same template retry the build instead of sharing the error.
+    """
+    with _template_build_errors():
+        return cached_template(
+            name, key, lambda: _run_template_build(build, *args),
+            retry=(Busy, WorkerUnavailable))
+
+
+def _run_template_build(build, *args):
+    """
+    Return build(*args) run in the worker pool, if enabled
+    """
+    with request_slot():
+        return run_heavy(build, *args)
+
+
+@contextmanager
+def _template_build_errors():
+    """
+    Abort with 429 or 503 when a template can't be built now
+    """
+    try:
+        yield
+    except Busy as e:
+        response = Response(e.message, status=429, content_type='text/plain')
+        response.headers['Retry-After'] = str(e.retry_after)
+        flask_abort(response)
+    except WorkerUnavailable:
+        abort(503, _("The template is taking too long to build. "
+            "Please try again later."))
+
+
+def _build_template(resource, dd):
+    from ckanext.excelforms.write_excel import excel_template
+    return _template_bytes(excel_template(resource, dd))
+
+
+def _build_dataset_template(package, resources):
+    from ckanext.excelforms.write_excel import excel_dataset_template
+    return _template_bytes(excel_dataset_template(package, resources))
+
+
+def _template_bytes(book):
     blob = BytesIO()
     book.save(blob)
-    response = Response(blob.getvalue())
+    return blob.getvalue()
+
+
+def _template_response(blob, resource_id):
+    response = Response(blob)
     response.content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     response.headers['Content-Disposition'] = (
         'inline; filename="template_{0}.xlsx"'.format(resource_id))
     return response
 
 
-def _process_upload_file(lc, resource_id, upload_file, dd, dry_run):
+def _process_upload_file(lc, resource_id, upload_file, dd, dry_run,
+        filename=None, content_type=None, stream=False, on_disk=False):
+    """
+    Use lc.action.datastore_upsert to load data from upload_file, an
+    excel template, a CSV/TSV file with a header row of column ids or
+    an NDJSON file. upload_file is a form upload, the request body
+    stream when stream is True, or a regular file opened by name when
+    on_disk is True.
+
+    Uploads are spooled to a temporary file first, except NDJSON
+    request bodies which are read line by line as they arrive when
+    concurrent requests aren't limited. A request slot is only held
+    while the spooled file is read and loaded, so slow transfers
+    don't keep other users waiting.
+
+    An identical upload by the same user within
+    ckanext.excelforms.upload_dedupe_window seconds is answered with the
+    recorded result instead.
+
+    returns a dict with the number of records loaded and timings.
+    raises BadExcelData on errors.
+    """
+    from ckanext.excelforms.read_ndjson import is_ndjson
+    filename = filename or getattr(upload_file, 'filename', None)
+    content_type = content_type or getattr(upload_file, 'mimetype', None)
+
+    if (stream and is_ndjson(filename, content_type)
+            and not concurrency_limited()):
+        return _load_upload_file(
+            lc, resource_id, upload_file, dd, dry_run, filename, content_type)
+
+    with spooled_upload(
+            upload_file,
+            _upload_limits()['max_bytes'],
+            on_disk) as (spool, sha256):
+        process = lambda: _load_spooled_file(
+            lc, resource_id, spool, dd, dry_run, filename, content_type)
+        results = upload_results()
+        if results is None:
+            return process()
+        key = fingerprint(
+            lc.username,
+            sha256,
+            dd,
+            dry_run,
+            filename,
+            content_type)
+        return deduplicated(results, resource_id, key, process)
+
+
+@limited
+def _load_spooled_file(lc, resource_id, upload_file, dd, dry_run, filename,
+        content_type):
+    return _load_upload_file(
+        lc, resource_id, upload_file, dd, dry_run, filename, content_type)
+
+
+def _load_upload_file(lc, resource_id, upload_file, dd, dry_run, filename,
+        content_type):
+    from ckanext.excelforms.read_csv import csv_delimiter, read_csv
+    from ckanext.excelforms.read_ndjson import is_ndjson, read_ndjson
+    from ckanext.excelforms.read_excel import check_excel_size
+    start = time.time()
+    limits = _upload_limits()
+    delimiter = csv_delimiter(filename, content_type)
+
+    if is_ndjson(filename, content_type):
+        upload_data = read_ndjson(
+            upload_file,
+            resource_id,
+            [f['id'] for f in dd if f['id'] != '_id'],
+            limits['max_rows'],
+            limits['max_bytes'])
+    elif delimiter:
+        check_excel_size(upload_file, limits['max_bytes'])
+        upload_data = read_csv(
+            upload_file,
+            resource_id,
+            [f['id'] for f in dd if f['id'] != '_id'],
+            delimiter,
+            limits['max_rows'],
+            limits['max_columns'])
+    else:
+        upload_data = None
+        if workers_enabled():
+            # file objects can't be passed to worker processes, but
+            # they can open the spooled file by name
+            upload_file = upload_file.name
+        try:
+            sheet_name, records = run_heavy(
+                _read_excel_records, upload_file, resource_id, dd, limits)
+        except WorkerUnavailable:
+            raise BadExcelData(_(
+                "The file uploaded took too long to process. Please try "
+                "again later or split the data into smaller files."))
+
+    if upload_data is not None:
+        sheet_name, res_id, column_names, rows = _read_upload(upload_data)
+        _check_upload_columns(resource_id, res_id, column_names, dd)
+        records = _get_sheet_records(rows, dd)
+
+    if not records:
+        raise BadExcelData(_("The template uploaded is empty"))
+    read_done = time.time()
+    method = _load_records(lc, resource_id, records, dd, sheet_name, dry_run)
+
+    end = time.time()
+    return {
+        'resource_id': resource_id,
+        'method': method,
+        'dry_run': dry_run,
+        'records': len(records),
+        'timings': {
+            'read': round(read_done - start, 3),
+            'datastore': round(end - read_done, 3),
+            'total': round(end - start, 3),
+            },
+        }
+
+
+@limited
+def _process_dataset_upload_file(lc, resource_dds, upload_file, dry_run):
+    """
+    Use lc.action.datastore_upsert to load data from upload_file, a
+    dataset template with a form sheet for some or all of resource_dds,
+    an OrderedDict of {resource_id: dd}
+
+    Every sheet is read and validated before any data is loaded, and
+    all sheets are loaded in a single transaction so either every
+    resource is updated or none are.
+
+    returns a list of {'resource_id', 'method', 'records'} dicts.
+    raises BadExcelData on errors.
+    """
+    from ckanext.excelforms.read_excel import (
+        read_excel, read_excel_headers, check_excel_size)
+    limits = _upload_limits()
+    check_excel_size(
+        upload_file,
+        limits['max_bytes'],
+        limits['max_uncompressed_bytes'])
+
+    # reject the wrong template without loading the whole workbook
+    with _upload_errors():
+        headers = list(read_excel_headers(upload_file, limits['max_columns']))
+    for sheet_name, res_id, column_names in headers:
+        if res_id not in resource_dds:
+            raise BadExcelData(
+                _("This template is for a different resource: {0}").format(
+                    res_id))
+        _check_upload_columns(
+            res_id, res_id, column_names, resource_dds[res_id])
+    upload_file.seek(0)
+
+    sheets = []
+    with _upload_errors():
+        for sheet_name, res_id, column_names, rows in read_excel(
+                upload_file,
+                max_rows=limits['max_rows'],
+                max_columns=limits['max_columns']):
+            try:
+                records = _get_sheet_records(rows, resource_dds[res_id])
+            except BadExcelData as e:
+                raise BadExcelData(
+                    _(u'Sheet {0}:').format(sheet_name) + u' ' + e.message,
+                    row=e.row)
+            if records:
+                sheets.append((sheet_name, res_id, records))
+    if not sheets:
+        raise BadExcelData(_("The template uploaded is empty"))
+
+    # load every sheet in one transaction: all resources or none
+    from ckanext.excelforms.datastore import transaction, upsert_batch_size
+    batch_size = upsert_batch_size()
+    results = []
+    with transaction(lc, dry_run) as load:
+        for sheet_name, res_id, records in sheets:
+            method = _load_method(lc, res_id, records, resource_dds[res_id])
+            try:
+                load(res_id, records, resource_dds[res_id], method,
+                    batch_size)
+            except ValidationError as e:
+                raise _upsert_error(e, records, sheet_name)
+            except BadExcelData as e:
+                raise BadExcelData(
+                    _(u'Sheet {0}:').format(sheet_name) + u' ' + e.message,
+                    row=e.row)
+            results.append({
+                'resource_id': res_id,
+                'method': method,
+                'records': len(records),
+                })
+    return results
+
+
+def _get_sheet_records(rows, dd):
+    """
+    Return the canonicalized and validated Records for rows of data
+    from a sheet for data dictionary dd
+
+    Rows with the same primary key are all reported at once, before
+    any data is sent to the datastore.
+
+    raises BadExcelData on errors.
+    """
+    from ckanext.excelforms.read_excel import get_records
+    from ckanext.excelforms.validation import get_validators
+    pk = _primary_key_fields(dd)
+    records = get_records(
+        rows,
+        [f for f in dd if f['id'] != '_id'],
+        pk,
+        get_choice_fields(dd),
+        get_validators(dd))
+    if pk:
+        _check_duplicate_keys(records, pk)
+    return records
+
+
+def _check_duplicate_keys(records, pk):
+    """
+    raises BadExcelData listing rows that repeat the primary key of
+    an earlier row
+    """
+    duplicates = records.duplicate_keys(pk)
+    if not duplicates:
+        return
+    rows = u', '.join(
+        _(u'row {0} (same as row {1})').format(n, first)
+        for n, first in duplicates[:MAX_REPORTED_DUPLICATES])
+    if len(duplicates) > MAX_REPORTED_DUPLICATES:
+        rows += u' ' + _(u'and {0} more').format(
+            len(duplicates) - MAX_REPORTED_DUPLICATES)
+    raise BadExcelData(
+        _(u'Duplicate values for {0}: {1}').format(u', '.join(pk), rows),
+        row=duplicates[0][0])
+
+
+def _load_method(lc, resource_id, records, dd):
+    """
+    Return 'upsert' when the table has a primary key, sorting records
+    by the key, otherwise 'copy' when COPY is enabled for this resource
+    and user, or 'insert'
+    """
+    from ckanext.excelforms.datastore import use_copy, sort_by_key
+    pk = _primary_key_fields(dd)
+    if pk:
+        sort_by_key(records, dd, pk)
+        return 'upsert'
+    if use_copy(resource_id, lc.username):
+        return 'copy'
+    return 'insert'
+
+
+def _load_records(lc, resource_id, records, dd, sheet_name, dry_run):
+    """
+    Upsert records sorted by primary key when the table has one,
+    otherwise insert them with COPY when enabled for this resource and
+    user, or with datastore_upsert
+
+    returns the method used.
+    raises BadExcelData on errors.
+    """
+    from ckanext.excelforms.datastore import copy_records
+    method = _load_method(lc, resource_id, records, dd)
+    if method == 'copy':
+        copy_records(lc, resource_id, records, dd, dry_run)
+    else:
+        _upsert_records(
+            lc, resource_id, records, sheet_name, method, dry_run)
+    return method
+
+
+def _upsert_records(lc, resource_id, records, sheet_name, method, dry_run):
     """
-    Use lc.action.datastore_upsert to load data from upload_file
+    Load records with datastore_upsert, or in batches within a single
+    transaction when there are more than upsert_batch_size records
 
     raises BadExcelData on errors.
     """
-    upload_data = read_excel(upload_file)
-    total_records = 0
+    from ckanext.excelforms.datastore import (
+        upsert_batch_size, upsert_batches)
+    batch_size = upsert_batch_size()
     try:
-        sheet_name, res_id, column_names, rows = next(upload_data)
+        if batch_size and len(records) > batch_size:
+            upsert_batches(
+                lc, resource_id, records, method, dry_run, batch_size)
+        else:
+            lc.action.datastore_upsert(
+                method=method,
+                resource_id=resource_id,
+                records=records.dicts(),
+                dry_run=dry_run,
+                force=True,
+                )
+    except ValidationError as e:
+        raise _upsert_error(e, records, sheet_name)
+
+
+def _upsert_error(e, records, sheet_name):
+    """
+    Return BadExcelData for ValidationError e raised by datastore_upsert
+    while loading records from sheet_name
+    """
+    if 'info' in e.error_dict:
+        # because, where else would you put the error text?
+        # XXX improve this in datastore, please
+        pgerror = e.error_dict['info']['orig']
+        if isinstance(pgerror, list):
+            pgerror = pgerror[0]
+        if isinstance(pgerror, bytes):
+            pgerror = pgerror.decode('utf-8')
+    elif 'records' in e.error_dict:
+        pgerror = e.error_dict['records'][0]
+    else:
+        pgerror = u'; '.join(
+            u', '.join(v) if isinstance(v, list) else text_type(v)
+            for k, v in e.error_dict.items())
+    if isinstance(pgerror, dict):
+        pgerror = u'; '.join(
+            k + u': ' + u', '.join(v)
+            for k, v in pgerror.items())
+    else:
+        # remove some postgres-isms that won't help the user
+        # when we render this as an error in the form
+        pgerror = re.sub(r'\nLINE \d+:', '', pgerror)
+        pgerror = re.sub(r'\n *\^\n$', '', pgerror)
+    records_row = e.error_dict.get(
+        'records_row', e.error_dict.get('_records_row'))
+    if records_row is not None:
+        row = records.row_numbers[records_row]
+        return BadExcelData(_(u'Sheet {0} Row {1}:').format(
+            sheet_name, row)
+            + u' ' + pgerror, row=row)
+    return BadExcelData(
+        _(u"Error while importing data: {0}").format(
+            pgerror))
+
+
+def _read_excel_records(upload_file, resource_id, dd, limits):
+    """
+    Read, check and canonicalize the data from the form sheet of an
+    uploaded excel template, given as a file object or file name
+
+    returns (sheet_name, records).
+    raises BadExcelData on errors.
+    """
+    if isinstance(upload_file, text_type):
+        with open(upload_file, 'rb') as f:
+            return _read_excel_records(f, resource_id, dd, limits)
+    sheet_name, res_id, column_names, rows = _read_upload(
+        _read_excel_upload(upload_file, resource_id, dd, limits))
+    _check_upload_columns(resource_id, res_id, column_names, dd)
+    return sheet_name, _get_sheet_records(rows, dd)
+
+
+def _read_excel_upload(upload_file, resource_id, dd, limits):
+    """
+    Check limits and headers of an uploaded excel file then return a
+    read_excel generator for it
+
+    raises BadExcelData on errors.
+    """
+    from ckanext.excelforms.read_excel import (
+        read_excel, read_excel_headers, check_excel_size)
+    check_excel_size(
+        upload_file,
+        limits['max_bytes'],
+        limits['max_uncompressed_bytes'])
+
+    # reject the wrong template without loading the whole workbook
+    sheet_name, res_id, column_names = _read_upload(
+        read_excel_headers(upload_file, limits['max_columns']))
+    _check_upload_columns(resource_id, res_id, column_names, dd)
+    upload_file.seek(0)
+
+    return read_excel(
+        upload_file,
+        max_rows=limits['max_rows'],
+        max_columns=limits['max_columns'])
+
+
+def _upload_limits():
+    """
+    Return the configured upload limits, 0 disables a limit
+    """
+    return {
+        'max_bytes': int(config.get(
+            'ckanext.excelforms.max_upload_bytes',
+            DEFAULT_MAX_UPLOAD_BYTES)),
+        'max_uncompressed_bytes': int(config.get(
+            'ckanext.excelforms.max_uncompressed_bytes',
+            DEFAULT_MAX_UNCOMPRESSED_BYTES)),
+        'max_rows': int(config.get(
+            'ckanext.excelforms.max_rows',
+            DEFAULT_MAX_ROWS)),
+        'max_columns': int(config.get(
+            'ckanext.excelforms.max_columns',
+            DEFAULT_MAX_COLUMNS)),
+        }
+
+
+def _read_upload(upload_data):
+    """
+    Return the first item produced by upload_data, a read_excel or
+    read_excel_headers generator
+
+    raises BadExcelData on errors.
+    """
+    with _upload_errors():
+        return next(upload_data)
+
+
+@contextmanager
+def _upload_errors():
+    """
+    Convert unexpected errors while reading an uploaded file into
+    BadExcelData
+    """
+    try:
+        yield
     except BadExcelData as e:
         raise e
     except Exception:
@@ -128,6 +879,14 @@ def _process_upload_file(lc, resource_id, upload_file, dd, dry_run):
             "uploaded. Please try copying your data into the latest "
             "version of the template and uploading again."))
 
+
+def _check_upload_columns(resource_id, res_id, column_names, dd):
+    """
+    Compare the resource id and column names from an uploaded template
+    with the data dictionary
+
+    raises BadExcelData on errors.
+    """
     if resource_id != res_id:
         raise BadExcelData(
             _("This template is for a different resource: {0}").format(res_id)
@@ -145,55 +904,3 @@ def _process_upload_file(lc, resource_id, upload_file, dd, dry_run):
             _("This template is out of date. "
             "Please try copying your data into the latest "
             "version of the template and uploading again."))
-
-    pk = []
-#    pk = chromo.get('datastore_primary_key', [])
-    choice_fields = {}
-#    choice_fields = {
-#        f['datastore_id']:
-#            'full' if f.get('excel_full_text_choices') else True
-#        for f in chromo['fields']
-#        if ('choices' in f or 'choices_file' in f)}
-
-    records = get_records(
-        rows,
-        [f for f in dd if f['id'] != '_id'],
-        pk,
-        choice_fields)
-    method = 'upsert' if pk else 'insert'
-    total_records += len(records)
-    if not records:
-        raise BadExcelData(_("The template uploaded is empty"))
-    try:
-        lc.action.datastore_upsert(
-            method=method,
-            resource_id=resource_id,
-            records=[r[1] for r in records],
-            dry_run=dry_run,
-            force=True,
-            )
-    except ValidationError as e:
-        if 'info' in e.error_dict:
-            # because, where else would you put the error text?
-            # XXX improve this in datastore, please
-            pgerror = e.error_dict['info']['orig'][0].decode('utf-8')
-        elif 'records' in e.error_dict:
-            pgerror = e.error_dict['records'][0]
-        else:
-            assert 0, e.error_dict
-        if isinstance(pgerror, dict):
-            pgerror = u'; '.join(
-                k + u': ' + u', '.join(v)
-                for k, v in pgerror.items())
-        else:
-            # remove some postgres-isms that won't help the user
-            # when we render this as an error in the form
-            pgerror = re.sub(r'\nLINE \d+:', '', pgerror)
-            pgerror = re.sub(r'\n *\^\n$', '', pgerror)
-        if '_records_row' in e.error_dict:
-            raise BadExcelData(_(u'Sheet {0} Row {1}:').format(
-                sheet_name, records[e.error_dict['_records_row']][0])
-                + u' ' + pgerror)
-        raise BadExcelData(
-            _(u"Error while importing data: {0}").format(
-                pgerror))
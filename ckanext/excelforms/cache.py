@@ -0,0 +1,191 @@
+"""
+Template cache and single-flight coordination of template builds
+"""
+
+import os
+import fcntl
+import glob
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import simplejson as json
+
+from ckan.plugins.toolkit import config
+
+
+def fingerprint(*values):
+    """
+    Return a hex digest identifying the JSON-serializable values passed,
+    e.g. a resource and its data dictionary
+    """
+    return hashlib.sha1(json.dumps(
+        values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    """
+    Small thread-safe least-recently-used cache for values derived from
+    a data dictionary, keyed by fingerprint
+    """
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def get_or_create(self, key, create):
+        with self._lock:
+            if key in self._values:
+                value = self._values.pop(key)
+                self._values[key] = value
+                return value
+        value = create()
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
+        return value
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Run at most one call per key at a time within this process. Callers
+    arriving while a call for their key is running wait for it and share
+    its result (or exception) instead of repeating the work.
+
+    Exceptions of the types in retry belong to the caller that made the
+    call (e.g. its own request limit being reached) so waiters don't
+    share them, they call do() again, one of them becoming the new leader.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, retry=()):
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                break
+            call.event.wait()
+            if call.error is None:
+                return call.result
+            if not isinstance(call.error, retry):
+                raise call.error
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def _join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        return call, leader
+
+
+class FileCache(object):
+    """
+    Filesystem cache of generated files named {prefix}-{key}{suffix}.
+    Writes are atomic and an exclusive lock file lets one process build
+    a missing entry while the others wait for it.
+    """
+    def __init__(self, cache_dir, suffix=''):
+        self.cache_dir = cache_dir
+        self.suffix = suffix
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, prefix, key):
+        return os.path.join(
+            self.cache_dir, '{0}-{1}{2}'.format(prefix, key, self.suffix))
+
+    def get(self, prefix, key):
+        try:
+            with open(self._path(prefix, key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def set(self, prefix, key, value):
+        """
+        Store value, removing entries for older keys with the same prefix
+        """
+        path = self._path(prefix, key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        os.rename(tmp_path, path)
+        for old in glob.glob(self._path(prefix, '*')):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    @contextmanager
+    def lock(self, prefix):
+        lock_path = os.path.join(self.cache_dir, prefix + '.lock')
+        with open(lock_path, 'wb') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_template_builds = SingleFlight()
+
+
+def _template_cache():
+    cache_dir = config.get('ckanext.excelforms.template_cache_dir')
+    if not cache_dir:
+        return None
+    return FileCache(cache_dir, '.xlsx')
+
+
+def cached_template(name, key, build, retry=()):
+    """
+    Return the template bytes for name (e.g. resource id and language)
+    and key (a fingerprint of everything the template depends on),
+    calling build() only if no other thread or process is building or
+    has built the same template.
+
+    Callers waiting on another thread's build try building it themselves
+    when that build raised one of the exception types in retry.
+    """
+    return _template_builds.do(
+        (name, key),
+        lambda: _build_cached(_template_cache(), name, key, build),
+        retry)
+
+
+def _build_cached(cache, name, key, build):
+    if cache is None:
+        return build()
+    value = cache.get(name, key)
+    if value is not None:
+        return value
+    with cache.lock(name):
+        value = cache.get(name, key)
+        if value is None:
+            value = build()
+            cache.set(name, key, value)
+    return value
@@ -0,0 +1,140 @@
+"""
+Choice lists for choice fields defined in the data dictionary
+"""
+
+from collections import OrderedDict, namedtuple
+from logging import getLogger
+from numbers import Number
+
+from six import string_types, text_type
+
+from ckan.plugins.toolkit import asbool
+
+from ckanext.excelforms.cache import LRUCache, fingerprint
+
+log = getLogger(__name__)
+
+CHOICE_FIELDS_CACHE_SIZE = 100
+
+# Codifies a choice field:
+#    'choices': [(code, label), ...] in data dictionary order
+#    'codes': frozenset of valid codes for fast membership checks
+#    'full_text': True for "code: label" style choices
+#    'ref_rows': reference sheet rows for the choices
+#    'max_length': length of the longest first reference cell
+#    'valid_keys': comma-separated codes for validation messages
+ChoiceField = namedtuple(
+    'ChoiceField',
+    ['choices', 'codes', 'full_text', 'ref_rows', 'max_length',
+     'valid_keys'])
+
+_cache = LRUCache(CHOICE_FIELDS_CACHE_SIZE)
+
+
+def get_choice_fields(dd):
+    """
+    Return {field_id: ChoiceField} for choice fields in data dictionary dd
+
+    Choice lists are normalized and indexed once per data dictionary
+    fingerprint and shared by template builds and upload validation.
+    """
+    return _cache.get_or_create(fingerprint(dd), lambda: _choice_fields(dd))
+
+
+def _choice_fields(dd):
+    choice_fields = OrderedDict()
+    for f in dd:
+        info = f.get('info') or {}
+        choices = field_choices(info)
+        if not choices:
+            continue
+        choice_fields[f['id']] = _choice_field(
+            choices,
+            f['type'] != '_text' and asbool(
+                info.get('excelforms_full_text_choices', False)))
+    return choice_fields
+
+
+def field_choices(info):
+    """
+    Return [(code, label), ...] from the excelforms_choices value in a
+    data dictionary info dict. Choices may be given as text with one
+    "code" or "code: label" per line, a list of codes or [code, label]
+    pairs, or a {code: label} object.
+
+    Entries that are none of these, e.g. lists of three values or
+    nested objects, are logged and skipped so that one bad entry in a
+    data dictionary doesn't break its templates.
+    """
+    value = info.get('excelforms_choices')
+    if not value:
+        return []
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, string_types):
+        items = [
+            line.split(u':', 1) if u':' in line else (line, line)
+            for line in value.splitlines() if line.strip()]
+    elif isinstance(value, (list, tuple)):
+        items = [
+            (v, v) if _is_choice_value(v) else v
+            for v in value]
+    else:
+        log.warning('ignoring invalid excelforms_choices: %r', value)
+        return []
+
+    choices = []
+    seen = set()
+    for item in items:
+        if not (isinstance(item, (list, tuple)) and len(item) == 2
+                and all(_is_choice_value(v) for v in item)):
+            log.warning('ignoring invalid excelforms_choices entry: %r', item)
+            continue
+        code, label = item
+        code = text_type(code).strip()
+        if code in seen:
+            continue
+        seen.add(code)
+        choices.append((code, text_type(label).strip()))
+    return choices
+
+
+def _is_choice_value(value):
+    return isinstance(value, string_types) or (
+        isinstance(value, Number) and not isinstance(value, bool))
+
+
+def _choice_field(choices, full_text):
+    ref_rows = []
+    max_length = 0
+    for key, value in choices:
+        if full_text:
+            choice = [u'{0}: {1}'.format(key, value)]
+        elif key == value:
+            choice = [key]
+        else:
+            choice = [key, value]
+        ref_rows.append(('choice', choice))
+        max_length = max(max_length, len(choice[0]))
+    codes = [c[0] for c in choices]
+    return ChoiceField(
+        choices=choices,
+        codes=frozenset(codes),
+        full_text=full_text,
+        ref_rows=ref_rows,
+        max_length=max_length,
+        valid_keys=u', '.join(codes))
+
+
+def invalid_choices(choice_field, value):
+    """
+    Return the list of codes in canonicalized value that are not valid
+    choices for choice_field
+    """
+    if value is None or value == u'':
+        return []
+    if isinstance(value, list):
+        return [v for v in value if v not in choice_field.codes]
+    if value not in choice_field.codes:
+        return [value]
+    return []
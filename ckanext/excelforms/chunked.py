@@ -0,0 +1,256 @@
+"""
+Resumable chunked uploads spooled to local disk
+
+A client creates an upload with the total size (and optionally the
+sha256 of the whole file), sends chunks with their offsets and
+checksums in any order, asks which ranges were received after a
+failure, and completes the upload once every byte has arrived.
+"""
+
+import os
+import re
+import time
+import uuid
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+import simplejson as json
+
+from ckan.plugins.toolkit import _, config
+
+from ckanext.excelforms.errors import BadExcelData
+
+DEFAULT_UPLOAD_EXPIRY = 24 * 60 * 60
+DEFAULT_MAX_UPLOADS_PER_USER = 5
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def chunked_uploads():
+    """
+    Return ChunkedUploads for the configured spool directory
+    """
+    return ChunkedUploads(
+        config.get('ckanext.excelforms.chunked_upload_dir')
+        or os.path.join(tempfile.gettempdir(), 'excelforms-uploads'),
+        int(config.get(
+            'ckanext.excelforms.chunked_upload_expiry',
+            DEFAULT_UPLOAD_EXPIRY)),
+        int(config.get(
+            'ckanext.excelforms.chunked_uploads_per_user',
+            DEFAULT_MAX_UPLOADS_PER_USER)))
+
+
+class ChunkedUploads(object):
+    """
+    Uploads are stored as {upload_id}.part files written in place at
+    each chunk's offset, with the received ranges and other details in
+    {upload_id}.json. Writes to the same upload are serialized with
+    a lock file so chunks may be sent in parallel.
+
+    Each user may have max_per_user unfinished uploads (0 for no
+    limit), and uploads not written to for expiry seconds are removed
+    whenever an upload is created, written or completed.
+    """
+    def __init__(self, upload_dir, expiry=DEFAULT_UPLOAD_EXPIRY,
+            max_per_user=DEFAULT_MAX_UPLOADS_PER_USER):
+        self.upload_dir = upload_dir
+        self.expiry = expiry
+        self.max_per_user = max_per_user
+        if not os.path.isdir(upload_dir):
+            os.makedirs(upload_dir)
+
+    def _path(self, upload_id, suffix):
+        if not UPLOAD_ID_RE.match(upload_id):
+            raise BadExcelData(_('Upload not found'))
+        return os.path.join(self.upload_dir, upload_id + suffix)
+
+    def create(self, resource_id, user, size, filename=None, sha256=None,
+            max_bytes=None):
+        """
+        Start a new upload of size bytes and return its status
+        """
+        if size <= 0:
+            raise BadExcelData(_('The upload size must be given'))
+        if max_bytes and size > max_bytes:
+            raise BadExcelData(
+                _('The file uploaded is too large. The maximum size is '
+                '{0} bytes').format(max_bytes))
+        self.remove_expired()
+
+        upload_id = uuid.uuid4().hex
+        meta = {
+            'upload_id': upload_id,
+            'resource_id': resource_id,
+            'user': user,
+            'size': size,
+            'filename': filename,
+            'sha256': sha256,
+            'received': [],
+            'created': time.time(),
+            }
+        with self._locked(os.path.join(self.upload_dir, 'create.lock')):
+            if self.max_per_user and len(
+                    self._user_uploads(user)) >= self.max_per_user:
+                raise BadExcelData(_(
+                    'Too many unfinished uploads, the maximum is {0}. '
+                    'Complete or delete an upload before starting '
+                    'another.').format(self.max_per_user))
+            with open(self._path(upload_id, '.part'), 'wb') as f:
+                f.truncate(size)
+            self._save(meta)
+        return status(meta)
+
+    def get(self, upload_id, resource_id, user):
+        """
+        Return the details of an upload started by user for resource_id
+        """
+        try:
+            with open(self._path(upload_id, '.json')) as f:
+                meta = json.load(f)
+        except IOError:
+            raise BadExcelData(_('Upload not found'))
+        if meta['resource_id'] != resource_id or meta['user'] != user:
+            raise BadExcelData(_('Upload not found'))
+        return meta
+
+    def write(self, upload_id, resource_id, user, offset, data,
+            sha256=None):
+        """
+        Store one chunk of data at offset and return the upload status.
+        Chunks may be re-sent, e.g. after a failed transfer.
+        """
+        if sha256 and hashlib.sha256(data).hexdigest() != sha256.lower():
+            raise BadExcelData(_('Chunk checksum does not match'))
+        self.remove_expired()
+        self.get(upload_id, resource_id, user)
+        with self._lock(upload_id):
+            meta = self.get(upload_id, resource_id, user)
+            end = offset + len(data)
+            if offset < 0 or end > meta['size']:
+                raise BadExcelData(
+                    _('Chunk is outside the upload size of {0} bytes').format(
+                        meta['size']))
+            if not data:
+                return status(meta)
+            with open(self._path(upload_id, '.part'), 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+            meta['received'] = add_range(meta['received'], offset, end)
+            self._save(meta)
+        return status(meta)
+
+    @contextmanager
+    def open(self, upload_id, resource_id, user):
+        """
+        Context manager returning the completed upload file, checking
+        that every byte was received and the whole file checksum
+        """
+        self.remove_expired()
+        meta = self.get(upload_id, resource_id, user)
+        if not status(meta)['complete']:
+            raise BadExcelData(_('Upload is missing chunks'))
+        with open(self._path(upload_id, '.part'), 'rb') as f:
+            if meta['sha256']:
+                digest = hashlib.sha256()
+                for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+                    digest.update(block)
+                if digest.hexdigest() != meta['sha256'].lower():
+                    raise BadExcelData(_('File checksum does not match'))
+                f.seek(0)
+            yield f
+
+    def complete(self, upload_id, resource_id, user, process, keep=False):
+        """
+        Return process(f) for the completed upload file f, removing the
+        upload once process succeeds unless keep is True. Uploads are
+        kept when process raises so the client can complete again,
+        e.g. after fixing the data or when told to retry later.
+        """
+        with self.open(upload_id, resource_id, user) as f:
+            result = process(f)
+        if not keep:
+            self.remove(upload_id)
+        return result
+
+    def remove(self, upload_id):
+        for suffix in ('.part', '.json', '.lock'):
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except OSError:
+                pass
+
+    def remove_expired(self):
+        cutoff = time.time() - self.expiry
+        for name in os.listdir(self.upload_dir):
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json' or not UPLOAD_ID_RE.match(upload_id):
+                continue
+            try:
+                if os.path.getmtime(
+                        os.path.join(self.upload_dir, name)) < cutoff:
+                    self.remove(upload_id)
+            except OSError:
+                pass
+
+    def _user_uploads(self, user):
+        uploads = []
+        for name in os.listdir(self.upload_dir):
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json' or not UPLOAD_ID_RE.match(upload_id):
+                continue
+            try:
+                with open(os.path.join(self.upload_dir, name)) as f:
+                    meta = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if meta['user'] == user:
+                uploads.append(upload_id)
+        return uploads
+
+    def _save(self, meta):
+        path = self._path(meta['upload_id'], '.json')
+        fd, tmp_path = tempfile.mkstemp(dir=self.upload_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, path)
+
+    def _lock(self, upload_id):
+        return self._locked(self._path(upload_id, '.lock'))
+
+    @contextmanager
+    def _locked(self, lock_path):
+        with open(lock_path, 'wb') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def add_range(ranges, start, end):
+    """
+    Return sorted, merged [[start, end], ...] byte ranges with
+    start:end added
+    """
+    merged = []
+    for r_start, r_end in sorted(ranges + [[start, end]]):
+        if merged and r_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], r_end)
+        else:
+            merged.append([r_start, r_end])
+    return merged
+
+
+def status(meta):
+    """
+    Return the client-visible status of an upload
+    """
+    return {
+        'upload_id': meta['upload_id'],
+        'size': meta['size'],
+        'received': meta['received'],
+        'complete': meta['received'] == [[0, meta['size']]],
+        }
@@ -0,0 +1,316 @@
+"""
+Bulk loading of uploads into the datastore: PostgreSQL COPY for
+insert-only uploads, and batched upserts, for one or more tables in a
+single transaction
+
+Records are written with the datastore backend's upsert_data (or COPY)
+on a connection of our own instead of calling datastore_upsert once per
+batch, so that all batches and tables share one transaction. Compared
+with datastore_upsert this skips the action's validation of its other
+parameters and its read-only resource check (uploads always used
+force=True), and the datastore_upsert signal is sent once per table
+after commit with no records instead of with the records loaded. Rows
+are validated against the data dictionary before loading, and
+upsert_data still checks each record's fields.
+"""
+
+import re
+from contextlib import contextmanager
+from logging import getLogger
+
+from decimal import Decimal, InvalidOperation
+
+import psycopg2
+import sqlalchemy as sa
+import simplejson as json
+from six import text_type
+
+from ckan.plugins.toolkit import _, config, aslist, asbool, check_access
+from ckan import authz
+from ckan.logic import ValidationError
+from ckanext.datastore.backend.postgres import (
+    get_read_engine, get_write_engine, identifier, upsert_data)
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.validation import NUMERIC_TYPES
+
+log = getLogger(__name__)
+
+COPY_BUFFER_SIZE = 64 * 1024
+DEFAULT_UPSERT_BATCH_SIZE = 10000
+# same default as the datastore backend's statement timeout
+DEFAULT_STATEMENT_TIMEOUT = 60000
+COPY_LINE_RE = re.compile(r'COPY .*, line (\d+)')
+
+# the unique index datastore_upsert matches records on, with columns in
+# index order
+PRIMARY_KEY_SQL = u'''
+    SELECT a.attname
+    FROM pg_index idx
+    JOIN pg_class t ON t.oid = idx.indrelid
+    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(idx.indkey)
+    WHERE t.relname = :relname
+        AND t.relkind = 'r'
+        AND idx.indisunique
+        AND NOT idx.indisprimary
+    ORDER BY array_position(idx.indkey::int2[], a.attnum)
+'''
+
+
+def use_copy(resource_id, username):
+    """
+    Return True when uploads to resource_id by username should be loaded
+    with COPY: resources listed in ckanext.excelforms.copy_resource_ids,
+    or any resource for sysadmins when ckanext.excelforms.copy_sysadmins
+    is enabled.
+    """
+    if resource_id in aslist(config.get(
+            'ckanext.excelforms.copy_resource_ids', '')):
+        return True
+    return asbool(config.get(
+        'ckanext.excelforms.copy_sysadmins', False)
+        ) and authz.is_sysadmin(username)
+
+
+def primary_key_fields(resource_id):
+    """
+    Return the field ids of the primary key of the datastore table for
+    resource_id, or [] when it has none
+    """
+    with get_read_engine().connect() as connection:
+        return [row[0] for row in connection.execute(
+            sa.text(PRIMARY_KEY_SQL), {'relname': resource_id})]
+
+
+def sort_by_key(records, dd, key_fields):
+    """
+    Sort records (a Records object) by key_fields, comparing numeric
+    fields as numbers, so that upserts visit the primary key index in
+    order instead of jumping between pages
+    """
+    types = dict((f['id'], f['type']) for f in dd)
+    positions = [
+        (records.field_ids.index(f), types.get(f) in NUMERIC_TYPES)
+        for f in key_fields]
+
+    def key(values):
+        return tuple(_key_value(values[i], numeric) for i, numeric in positions)
+    records.sort(key)
+
+
+def _key_value(value, numeric):
+    # numbers sort before anything that isn't one
+    if numeric:
+        try:
+            number = Decimal(value)
+        except (InvalidOperation, TypeError, ValueError):
+            number = None
+        if number is not None and not number.is_nan():
+            return (0, number, u'')
+    if isinstance(value, list):
+        value = u','.join(value)
+    return (1, 0, value or u'')
+
+
+def copy_records(lc, resource_id, records, dd, dry_run):
+    """
+    Insert records (a Records object) into the datastore table for
+    resource_id with COPY in a single transaction, rolled back for
+    dry_run or on any error.
+
+    raises BadExcelData on errors.
+    """
+    with transaction(lc, dry_run) as load:
+        load(resource_id, records, dd, 'copy')
+
+
+def upsert_batch_size():
+    """
+    Return the configured number of records per upsert batch, 0 to
+    always send all records in a single datastore_upsert call
+    """
+    return int(config.get(
+        'ckanext.excelforms.upsert_batch_size', DEFAULT_UPSERT_BATCH_SIZE))
+
+
+def upsert_batches(lc, resource_id, records, method, dry_run, batch_size):
+    """
+    Insert or upsert records (a Records object) in batches of
+    batch_size, creating record dicts for one batch at a time. All
+    batches run in a single transaction that is rolled back for
+    dry_run or on any error, so nothing is loaded unless every batch
+    succeeds.
+
+    raises ValidationError like datastore_upsert, with records_row
+    relative to the start of records.
+    """
+    with transaction(lc, dry_run) as load:
+        load(resource_id, records, None, method, batch_size)
+
+
+def statement_timeout():
+    """
+    Return the configured statement timeout in milliseconds for each
+    COPY or upsert statement, 0 for no timeout
+    """
+    return int(config.get(
+        'ckanext.excelforms.statement_timeout', DEFAULT_STATEMENT_TIMEOUT))
+
+
+@contextmanager
+def transaction(lc, dry_run):
+    """
+    Context manager returning load(resource_id, records, dd, method,
+    batch_size=None) for loading records (a Records object) into one
+    or more datastore tables. method is 'copy' to insert with COPY, or
+    'insert' or 'upsert' to use datastore_upsert in batches of
+    batch_size records (all at once when not given).
+
+    Every load runs in a single transaction, committed when the block
+    completes unless dry_run and rolled back on any error, so either
+    all of the records are loaded or none are. Like datastore_upsert
+    each statement is cancelled after statement_timeout().
+
+    load raises BadExcelData for COPY errors, or ValidationError like
+    datastore_upsert with records_row relative to the start of records.
+    """
+    changed = []
+    with get_write_engine().connect() as connection:
+        trans = connection.begin()
+        connection.execute(sa.text(
+            u'SET LOCAL statement_timeout TO {0}'.format(
+                statement_timeout())))
+
+        def load(resource_id, records, dd, method, batch_size=None):
+            check_access(
+                'datastore_upsert',
+                {'user': lc.username},
+                {'resource_id': resource_id})
+            if method == 'copy':
+                _copy(connection, resource_id, records, dd)
+            else:
+                _upsert(
+                    connection, lc.username, resource_id, records, method,
+                    batch_size)
+            changed.append(resource_id)
+
+        try:
+            yield load
+        except Exception:
+            trans.rollback()
+            raise
+        if dry_run:
+            trans.rollback()
+        else:
+            trans.commit()
+
+    if not dry_run:
+        for resource_id in changed:
+            _records_changed(lc, resource_id)
+
+
+def _copy(connection, resource_id, records, dd):
+    types = dict((f['id'], f['type']) for f in dd)
+    sql = u'COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)'.format(
+        identifier(resource_id),
+        u', '.join(identifier(f) for f in records.field_ids))
+    stream = CopyStream(records, [types[f] for f in records.field_ids])
+
+    # COPY on the DBAPI connection, within the same transaction
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(sql, stream, COPY_BUFFER_SIZE)
+    except psycopg2.Error as e:
+        message = (e.diag.message_primary or text_type(e)).strip()
+        # COPY counts csv lines from 1, one per record sent
+        m = COPY_LINE_RE.search(e.diag.context or u'')
+        line = int(m.group(1)) if m else 0
+        if 0 < line <= len(records.row_numbers):
+            row = records.row_numbers[line - 1]
+            raise BadExcelData(
+                _(u'Row {0}:').format(row) + u' ' + message, row=row)
+        raise BadExcelData(
+            _(u"Error while importing data: {0}").format(message))
+    finally:
+        cursor.close()
+
+
+def _upsert(connection, username, resource_id, records, method,
+        batch_size):
+    context = {'connection': connection, 'user': username}
+    batch_size = batch_size or len(records) or 1
+    start = 0
+    try:
+        for start in range(0, len(records), batch_size):
+            upsert_data(context, {
+                'resource_id': resource_id,
+                'method': method,
+                'include_records': False,
+                'records': records.dicts(start, start + batch_size),
+                })
+    except ValidationError as e:
+        if 'records_row' in e.error_dict:
+            e.error_dict['records_row'] += start
+        raise
+
+
+def _records_changed(lc, resource_id):
+    # no records: only update the record count and last modified time.
+    # The records are already committed so a failure here mustn't be
+    # reported as a failed upload
+    try:
+        lc.action.datastore_upsert(
+            resource_id=resource_id,
+            records=[],
+            force=True)
+    except Exception:
+        log.exception(
+            'Updating resource %s after upload failed', resource_id)
+
+
+class CopyStream(object):
+    """
+    File-like object producing COPY csv lines for records on demand,
+    so rows are never all converted at once
+    """
+    def __init__(self, records, types):
+        self._rows = iter(records.values)
+        self._types = types
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            values = next(self._rows, None)
+            if values is None:
+                break
+            self._buffer += copy_line(values, self._types)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def copy_line(values, types):
+    """
+    Return one utf-8 encoded COPY csv line for canonicalized values.
+    NULLs are unquoted empty fields and all other values are quoted.
+    """
+    return (u','.join(
+        _copy_value(v, t) for v, t in zip(values, types)) + u'\n'
+        ).encode('utf-8')
+
+
+def _copy_value(value, dtype):
+    # same conversions as datastore_upsert
+    if value is None or (value == u'' and dtype != 'text'):
+        return u''
+    if dtype == 'nested':
+        value = json.dumps(value)
+    elif isinstance(value, list):
+        value = u'{' + u','.join(
+            u'"' + text_type(v).replace(u'\\', u'\\\\').replace(
+                u'"', u'\\"') + u'"'
+            for v in value) + u'}'
+    elif isinstance(value, bool):
+        value = u'true' if value else u'false'
+    return u'"' + text_type(value).replace(u'"', u'""') + u'"'
@@ -0,0 +1,143 @@
+"""
+Results of recent uploads, so that an identical file uploaded again
+(e.g. after a double-clicked submit button) is answered without
+parsing it or calling the datastore
+"""
+
+import os
+import time
+import tempfile
+
+import simplejson as json
+
+from ckan.plugins.toolkit import config
+
+from ckanext.excelforms.cache import FileCache, SingleFlight
+
+DEFAULT_DEDUPE_WINDOW = 0
+DEFAULT_DEDUPE_WAIT = 60
+# seconds between checks for the result of an identical upload
+# running in another process
+DEDUPE_POLL_INTERVAL = 0.25
+
+_uploads = SingleFlight()
+
+
+def upload_results():
+    """
+    Return UploadResults for the configured directory and window, or
+    None when ckanext.excelforms.upload_dedupe_window is not set
+    """
+    window = int(config.get(
+        'ckanext.excelforms.upload_dedupe_window', DEFAULT_DEDUPE_WINDOW))
+    if not window:
+        return None
+    return UploadResults(
+        config.get('ckanext.excelforms.upload_dedupe_dir')
+        or os.path.join(tempfile.gettempdir(), 'excelforms-dedupe'),
+        window,
+        int(config.get(
+            'ckanext.excelforms.upload_dedupe_wait', DEFAULT_DEDUPE_WAIT)))
+
+
+class UploadRunning(Exception):
+    """
+    Raised when an identical upload is being processed elsewhere
+    """
+    pass
+
+
+class UploadResults(object):
+    """
+    The result of the last successful upload to each resource, stored as
+    {resource_id}-{key}.json. Each upload replaces the previous result
+    for its resource, so a file is only recognized while it is still the
+    most recent upload and the data it loaded can't have been replaced
+    by another upload.
+
+    An upload being processed is marked with {resource_id}-{key}.running
+    for up to wait seconds, after which the marker is ignored in case
+    the process handling it died.
+    """
+    def __init__(self, cache_dir, window, wait=DEFAULT_DEDUPE_WAIT):
+        self.cache = FileCache(cache_dir, '.json')
+        self.window = window
+        self.wait = wait
+
+    def get(self, resource_id, key):
+        """
+        Return the result recorded for key within the window or None
+        """
+        value = self.cache.get(resource_id, key)
+        if value is None:
+            return None
+        entry = json.loads(value)
+        if time.time() - entry['created'] > self.window:
+            return None
+        return entry['result']
+
+    def set(self, resource_id, key, result):
+        self.cache.set(resource_id, key, json.dumps({
+            'created': time.time(),
+            'result': result,
+            }).encode('utf-8'))
+
+    def _marker(self, resource_id, key):
+        return os.path.join(
+            self.cache.cache_dir, '{0}-{1}.running'.format(resource_id, key))
+
+    def claim(self, resource_id, key):
+        """
+        Return the recorded result for key, or None after marking key as
+        being processed by the caller, or raise UploadRunning if another
+        process is processing it
+        """
+        with self.cache.lock(resource_id):
+            result = self.get(resource_id, key)
+            if result is not None:
+                return result
+            marker = self._marker(resource_id, key)
+            try:
+                if time.time() - os.path.getmtime(marker) < self.wait:
+                    raise UploadRunning()
+            except OSError:
+                pass
+            with open(marker, 'wb'):
+                pass
+
+    def release(self, resource_id, key):
+        try:
+            os.remove(self._marker(resource_id, key))
+        except OSError:
+            pass
+
+
+def deduplicated(results, resource_id, key, process):
+    """
+    Return the result recorded for key, or the result of process() after
+    recording it. Identical uploads arriving while process() runs wait
+    for it: in this process they share its result, in other processes
+    using the same directory they poll for the recorded result. Only
+    identical uploads wait for each other, and only for up to
+    results.wait seconds.
+
+    Recorded results are returned with 'duplicate': True
+    """
+    def run():
+        while True:
+            try:
+                result = results.claim(resource_id, key)
+            except UploadRunning:
+                time.sleep(DEDUPE_POLL_INTERVAL)
+                continue
+            if result is not None:
+                result['duplicate'] = True
+                return result
+            break
+        try:
+            result = process()
+            results.set(resource_id, key, result)
+        finally:
+            results.release(resource_id, key)
+        return result
+    return _uploads.do((resource_id, key), run)
@@ -3,5 +3,6 @@ class ExcelFormsException(Exception):
     pass
 
 class BadExcelData(ExcelFormsException):
-    def __init__(self, message):
+    def __init__(self, message, row=None):
         self.message = message
+        self.row = row
@@ -0,0 +1,420 @@
+"""
+Interpreter for a safe subset of Excel formulas, used to apply
+excelforms_error_formula rules to uploaded data on the server.
+
+Formulas are compiled once into nested python closures. Only
+literals, {field} references, operators and the functions in FUNCTIONS
+are supported; anything else (cell addresses, ranges, other functions)
+raises UnsupportedFormula at compile time.
+"""
+
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP, ROUND_FLOOR
+
+from six import text_type
+
+
+class UnsupportedFormula(Exception):
+    pass
+
+
+class ExcelError(Exception):
+    """
+    An Excel error value like #VALUE! produced while evaluating
+    """
+    pass
+
+
+TOKEN_RE = re.compile(r'''
+    (?P<ws>\s+)
+  | (?P<ref>\{[A-Za-z0-9_ ]+\})
+  | (?P<number>\d+(\.\d*)?([eE][+-]?\d+)?|\.\d+([eE][+-]?\d+)?)
+  | (?P<string>"([^"]|"")*")
+  | (?P<op><>|<=|>=|[-+*/^&=<>(),])
+  | (?P<name>[A-Za-z][A-Za-z0-9_.]*)
+''', re.VERBOSE)
+
+
+def _tokenize(text):
+    pos = 0
+    tokens = []
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if not m:
+            raise UnsupportedFormula(text[pos:])
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == 'ws':
+            continue
+        value = m.group(kind)
+        if kind == 'ref':
+            value = value[1:-1]
+        elif kind == 'string':
+            value = value[1:-1].replace('""', '"')
+        elif kind == 'number':
+            value = Decimal(value)
+        elif kind == 'name':
+            value = value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+
+def compile_formula(text, names):
+    """
+    Return a function evaluate(refs) for formula text, where refs is a
+    dict of {reference name: value or callable returning a value}
+
+    :param names: the {reference} names that may appear in the formula
+    """
+    parser = _Parser(_tokenize(text.lstrip('=')), names)
+    node = parser.expression()
+    if parser.peek() is not None:
+        raise UnsupportedFormula(text)
+    return node
+
+
+class _Parser(object):
+    COMPARISONS = ('=', '<>', '<', '>', '<=', '>=')
+
+    def __init__(self, tokens, names):
+        self.tokens = tokens
+        self.names = names
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+
+    def take(self, op=None):
+        token = self.peek()
+        if token is None or (op is not None and token != ('op', op)):
+            raise UnsupportedFormula(op)
+        self.pos += 1
+        return token
+
+    def is_op(self, *ops):
+        token = self.peek()
+        return token is not None and token[0] == 'op' and token[1] in ops
+
+    def expression(self):
+        left = self.concat()
+        while self.is_op(*self.COMPARISONS):
+            op = self.take()[1]
+            left = _binary(_compare, op, left, self.concat())
+        return left
+
+    def concat(self):
+        left = self.additive()
+        while self.is_op('&'):
+            self.take()
+            left = _binary(_concat, '&', left, self.additive())
+        return left
+
+    def additive(self):
+        left = self.term()
+        while self.is_op('+', '-'):
+            op = self.take()[1]
+            left = _binary(_arithmetic, op, left, self.term())
+        return left
+
+    def term(self):
+        left = self.power()
+        while self.is_op('*', '/'):
+            op = self.take()[1]
+            left = _binary(_arithmetic, op, left, self.power())
+        return left
+
+    def power(self):
+        left = self.unary()
+        while self.is_op('^'):
+            self.take()
+            left = _binary(_arithmetic, '^', left, self.unary())
+        return left
+
+    def unary(self):
+        if self.is_op('-'):
+            self.take()
+            operand = self.unary()
+            return lambda refs: -_number(operand(refs))
+        if self.is_op('+'):
+            self.take()
+            return self.unary()
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.take()
+        if kind in ('number', 'string'):
+            return lambda refs: value
+        if kind == 'ref':
+            if value not in self.names:
+                raise UnsupportedFormula(value)
+            return lambda refs: _resolve(refs, value)
+        if kind == 'op' and value == '(':
+            node = self.expression()
+            self.take(')')
+            return node
+        if kind == 'name':
+            if value not in FUNCTIONS:
+                raise UnsupportedFormula(value)
+            if not self.is_op('('):
+                if value in ('TRUE', 'FALSE'):
+                    return lambda refs: value == 'TRUE'
+                raise UnsupportedFormula(value)
+            self.take('(')
+            args = []
+            if not self.is_op(')'):
+                args.append(self.expression())
+                while self.is_op(','):
+                    self.take()
+                    args.append(self.expression())
+            self.take(')')
+            return FUNCTIONS[value](*args)
+        raise UnsupportedFormula(value)
+
+
+def _resolve(refs, name):
+    value = refs.get(name)
+    if callable(value):
+        value = value()
+    if value is None:
+        return u''
+    if isinstance(value, list):
+        return u','.join(value)
+    return value
+
+
+def _binary(fn, op, left, right):
+    return lambda refs: fn(op, left(refs), right(refs))
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return Decimal(int(value))
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(value)
+    if value == u'':
+        return Decimal(0)
+    try:
+        return Decimal(text_type(value).strip())
+    except InvalidOperation:
+        raise ExcelError('#VALUE!')
+
+
+def _text(value):
+    if isinstance(value, bool):
+        return u'TRUE' if value else u'FALSE'
+    if isinstance(value, Decimal):
+        return u'{0:f}'.format(value.normalize())
+    return text_type(value)
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, Decimal):
+        return value != 0
+    if value == u'':
+        return False
+    upper = text_type(value).upper()
+    if upper in (u'TRUE', u'FALSE'):
+        return upper == u'TRUE'
+    raise ExcelError('#VALUE!')
+
+
+def _compare(op, a, b):
+    def rank(v):
+        # Excel orders numbers < text < booleans
+        if isinstance(v, bool):
+            return (2, v)
+        if isinstance(v, Decimal):
+            return (0, v)
+        return (1, text_type(v).lower())
+    if a == u'':
+        a = Decimal(0) if isinstance(b, Decimal) else (
+            False if isinstance(b, bool) else a)
+    if b == u'':
+        b = Decimal(0) if isinstance(a, Decimal) else (
+            False if isinstance(a, bool) else b)
+    a, b = rank(a), rank(b)
+    return {
+        '=': a == b,
+        '<>': a != b,
+        '<': a < b,
+        '>': a > b,
+        '<=': a <= b,
+        '>=': a >= b,
+        }[op]
+
+
+def _concat(op, a, b):
+    return _text(a) + _text(b)
+
+
+def _arithmetic(op, a, b):
+    a, b = _number(a), _number(b)
+    if op == '+':
+        return a + b
+    if op == '-':
+        return a - b
+    if op == '*':
+        return a * b
+    if op == '/':
+        if not b:
+            raise ExcelError('#DIV/0!')
+        return a / b
+    try:
+        return a ** b
+    except (InvalidOperation, ArithmeticError):
+        raise ExcelError('#NUM!')
+
+
+def _function(min_args, max_args=None):
+    """
+    Decorator for functions taking evaluated arguments
+    """
+    def decorator(fn):
+        def compile_call(*args):
+            if len(args) < min_args or (
+                    max_args is not None and len(args) > max_args):
+                raise UnsupportedFormula(fn.__name__)
+            return lambda refs: fn(*[a(refs) for a in args])
+        return compile_call
+    return decorator
+
+
+def _and(*args):
+    return lambda refs: all(_bool(a(refs)) for a in args)
+
+
+def _or(*args):
+    return lambda refs: any(_bool(a(refs)) for a in args)
+
+
+def _if(cond, then=None, otherwise=None):
+    if then is None:
+        raise UnsupportedFormula('IF')
+
+    def evaluate(refs):
+        if _bool(cond(refs)):
+            return then(refs)
+        return otherwise(refs) if otherwise is not None else False
+    return evaluate
+
+
+def _iferror(value, fallback=None):
+    if fallback is None:
+        raise UnsupportedFormula('IFERROR')
+
+    def evaluate(refs):
+        try:
+            return value(refs)
+        except ExcelError:
+            return fallback(refs)
+    return evaluate
+
+
+def _iserror(value):
+    def evaluate(refs):
+        try:
+            value(refs)
+        except ExcelError:
+            return True
+        return False
+    return evaluate
+
+
+def _isnumber(value):
+    def evaluate(refs):
+        try:
+            return isinstance(value(refs), Decimal)
+        except ExcelError:
+            return False
+    return evaluate
+
+
+def _round(value, digits=Decimal(0)):
+    exp = Decimal(1).scaleb(-int(digits))
+    try:
+        return value.quantize(exp, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        # more digits than the decimal context precision
+        raise ExcelError('#NUM!')
+
+
+def _trim(value):
+    return re.sub(u' +', u' ', _text(value)).strip(u' ')
+
+
+def _left(value, n=Decimal(1)):
+    return _text(value)[:int(_number(n))]
+
+
+def _right(value, n=Decimal(1)):
+    n = int(_number(n))
+    return _text(value)[-n:] if n else u''
+
+
+def _mid(value, start, n):
+    start = int(_number(start)) - 1
+    return _text(value)[start:start + int(_number(n))]
+
+
+def _int(value):
+    return _number(value).to_integral_value(rounding=ROUND_FLOOR)
+
+
+def _mod(a, b):
+    a, b = _number(a), _number(b)
+    if not b:
+        raise ExcelError('#DIV/0!')
+    return a - b * (a / b).to_integral_value(rounding=ROUND_FLOOR)
+
+
+def _search(needle, haystack, start=Decimal(1)):
+    return _find(needle, haystack, start, ignore_case=True)
+
+
+def _find(needle, haystack, start=Decimal(1), ignore_case=False):
+    needle, haystack = _text(needle), _text(haystack)
+    if ignore_case:
+        needle, haystack = needle.lower(), haystack.lower()
+    index = haystack.find(needle, int(_number(start)) - 1)
+    if index < 0:
+        raise ExcelError('#VALUE!')
+    return Decimal(index + 1)
+
+
+FUNCTIONS = {
+    'TRUE': _function(0, 0)(lambda: True),
+    'FALSE': _function(0, 0)(lambda: False),
+    'AND': _and,
+    'OR': _or,
+    'NOT': _function(1, 1)(lambda v: not _bool(v)),
+    'IF': _if,
+    'IFERROR': _iferror,
+    'ISERROR': _iserror,
+    'ISNUMBER': _isnumber,
+    'ISTEXT': _function(1, 1)(
+        lambda v: not isinstance(v, (Decimal, bool)) and v != u''),
+    'ISBLANK': _function(1, 1)(lambda v: v == u''),
+    'LEN': _function(1, 1)(lambda v: Decimal(len(_text(v)))),
+    'TRIM': _function(1, 1)(_trim),
+    'UPPER': _function(1, 1)(lambda v: _text(v).upper()),
+    'LOWER': _function(1, 1)(lambda v: _text(v).lower()),
+    'LEFT': _function(1, 2)(_left),
+    'RIGHT': _function(1, 2)(_right),
+    'MID': _function(3, 3)(_mid),
+    'FIND': _function(2, 3)(_find),
+    'SEARCH': _function(2, 3)(_search),
+    'SUBSTITUTE': _function(3, 3)(
+        lambda v, old, new: _text(v).replace(_text(old), _text(new))),
+    'EXACT': _function(2, 2)(lambda a, b: _text(a) == _text(b)),
+    'VALUE': _function(1, 1)(_number),
+    'INT': _function(1, 1)(_int),
+    'ROUND': _function(1, 2)(
+        lambda v, d=Decimal(0): _round(_number(v), _number(d))),
+    'ABS': _function(1, 1)(lambda v: abs(_number(v))),
+    'MOD': _function(2, 2)(_mod),
+}
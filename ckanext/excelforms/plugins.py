@@ -2,7 +2,6 @@ import importlib
 import os
 import uuid
 
-from paste.deploy.converters import asbool
 from ckan.plugins.toolkit import _, h
 import ckan.plugins as p
 from ckan.lib.plugins import DefaultDatasetForm, DefaultTranslation
@@ -0,0 +1,104 @@
+"""
+Optional cProfile profiling of template and upload requests, for finding
+hot spots in production without a code deploy
+"""
+
+import os
+import io
+import time
+import pstats
+import marshal
+import cProfile
+from functools import wraps
+from logging import getLogger
+
+from flask import Response
+from ckan import authz
+from ckan.plugins.toolkit import config, asbool, request, g
+
+log = getLogger(__name__)
+
+DEFAULT_PROFILE_TOP = 25
+
+
+def profiled(view):
+    """
+    Decorator for views that runs view under cProfile when a sysadmin
+    passes ?profile=1 (or ?profile=attachment to download the stats) or
+    when ckanext.excelforms.profile is enabled.
+
+    The top functions by cumulative time are logged, and the stats are
+    saved to ckanext.excelforms.profile_dir when it is set.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        mode = _profile_mode()
+        if not mode:
+            return view(*args, **kwargs)
+
+        g.excelforms_profiling = True
+        profiler = cProfile.Profile()
+        start = time.time()
+        try:
+            response = profiler.runcall(view, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            name = u'{0}-{1}-{2}'.format(
+                view.__name__,
+                kwargs.get('resource_id', ''),
+                time.strftime('%Y%m%dT%H%M%S'))
+            _log_stats(profiler, name, elapsed)
+            _save_stats(profiler, name)
+
+        if mode == 'attachment':
+            return _stats_response(profiler, name)
+        return response
+    return wrapper
+
+
+def profiling():
+    """
+    Return True when the current request is being profiled, so that
+    callers can bypass caches and profile the real work
+    """
+    return bool(getattr(g, 'excelforms_profiling', False))
+
+
+def _profile_mode():
+    if asbool(config.get('ckanext.excelforms.profile', False)):
+        return 'log'
+    value = request.args.get('profile')
+    if not value or not authz.is_sysadmin(g.user):
+        return None
+    if value == 'attachment':
+        return 'attachment'
+    return 'log' if asbool(value) else None
+
+
+def _log_stats(profiler, name, elapsed):
+    top = int(config.get(
+        'ckanext.excelforms.profile_top', DEFAULT_PROFILE_TOP))
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(top)
+    log.info('profile %s (%.3fs):\n%s', name, elapsed, out.getvalue())
+
+
+def _save_stats(profiler, name):
+    profile_dir = config.get('ckanext.excelforms.profile_dir')
+    if not profile_dir:
+        return
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    path = os.path.join(profile_dir, name + '.prof')
+    profiler.dump_stats(path)
+    log.info('profile %s saved to %s', name, path)
+
+
+def _stats_response(profiler, name):
+    profiler.create_stats()
+    response = Response(marshal.dumps(profiler.stats))
+    response.content_type = 'application/octet-stream'
+    response.headers['Content-Disposition'] = (
+        'attachment; filename="{0}.prof"'.format(name))
+    return response
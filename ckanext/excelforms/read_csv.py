@@ -0,0 +1,93 @@
+import csv
+
+import unicodecsv
+
+from ckan.plugins.toolkit import _
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.read_excel import filter_rows
+
+CSV_HEADER_ROWS = 1
+
+# delimiters by file extension and content type
+CSV_DELIMITERS = {
+    '.csv': ',',
+    '.tsv': '\t',
+    '.tab': '\t',
+    'text/csv': ',',
+    'text/tab-separated-values': '\t',
+}
+
+
+def csv_delimiter(filename, content_type=None):
+    """
+    Return the delimiter for an uploaded CSV or TSV file, or None if the
+    file is not CSV or TSV
+    """
+    if content_type in CSV_DELIMITERS:
+        return CSV_DELIMITERS[content_type]
+    for ext, delimiter in CSV_DELIMITERS.items():
+        if ext.startswith('.') and (filename or '').lower().endswith(ext):
+            return delimiter
+
+
+def read_csv(f, resource_id, expected_columns, delimiter=',',
+        max_rows=None, max_columns=None):
+    """
+    Return a generator that reads the UTF-8 CSV or TSV file object f with
+    a header row of datastore column ids and produces rows in the same
+    form as read_excel, with columns in expected_columns order.
+
+    :param: f: file object
+    :param: resource_id: resource the file is being uploaded to
+    :param: expected_columns: datastore column ids in data dictionary order
+    :param: delimiter: ',' for CSV or '\\t' for TSV
+    :param: max_rows: maximum number of data rows or None
+    :param: max_columns: maximum number of columns or None
+
+    :return: Generator that produces:
+        (sheet-name, resource-id, column_names, data_rows_generator)
+    :rtype: generator
+    """
+    reader = unicodecsv.reader(
+        f, encoding='utf-8-sig', delimiter=delimiter)
+    try:
+        header = [c.strip() for c in next(reader)]
+    except StopIteration:
+        raise BadExcelData(_("The template uploaded is empty"))
+    except (UnicodeDecodeError, csv.Error):
+        raise BadExcelData(_('The file uploaded is not a valid UTF-8 CSV file'))
+
+    if max_columns and len(header) > max_columns:
+        raise BadExcelData(
+            _('The file uploaded has too many columns. The maximum is '
+            '{0}').format(max_columns))
+    if sorted(header) != sorted(expected_columns):
+        raise BadExcelData(
+            _('The first row must contain exactly these column ids: '
+            '{0}').format(u', '.join(expected_columns)))
+
+    order = [header.index(c) for c in expected_columns]
+
+    yield (
+        'csv',
+        resource_id,
+        list(expected_columns),
+        filter_rows(
+            _reorder(reader, order, len(header)),
+            CSV_HEADER_ROWS,
+            max_rows,
+            max_columns))
+
+
+def _reorder(reader, order, width):
+    try:
+        for n, row in enumerate(reader, CSV_HEADER_ROWS + 1):
+            if any(v.strip() for v in row[width:]):
+                raise BadExcelData(
+                    _(u'Row {0}: more values than column ids').format(n),
+                    row=n)
+            row.extend([None] * (width - len(row)))
+            yield [row[i] for i in order]
+    except (UnicodeDecodeError, csv.Error):
+        raise BadExcelData(_('The file uploaded is not a valid UTF-8 CSV file'))
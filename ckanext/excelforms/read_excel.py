@@ -1,19 +1,58 @@
 import re
+import posixpath
+from array import array
+from itertools import chain
+import zipfile
+from xml.etree import ElementTree
 
-import openpyxl
+from openpyxl.styles.numbers import (
+    builtin_format_code, is_date_format, is_timedelta_format)
+from openpyxl.utils import column_index_from_string
+from openpyxl.utils.datetime import (
+    from_excel, from_ISO8601, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904)
 from six import text_type
 
+from ckan.plugins.toolkit import _
+
 from ckanext.excelforms.datatypes import canonicalize
 from ckanext.excelforms.errors import BadExcelData
 
 HEADER_ROWS_V2 = 3
 HEADER_ROWS_V3 = 5
+CODE_ROW = 3
+EXAMPLE_ROW = 5
+DATA_FIRST_COL_NUM = 3
+
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+DOC_REL_NS = (
+    '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}')
+PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+OFFICE_DOCUMENT_REL = (
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+    'officeDocument')
+SHARED_STRINGS_REL = (
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+    'sharedStrings')
+STYLES_REL = (
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+    'styles')
+CELL_REF_RE = re.compile(r'([A-Z]+)(\d+)$')
 
-def read_excel(f, file_contents=None):
+def read_excel(f, file_contents=None, max_rows=None, max_columns=None):
     """
     Return a generator that opens the excel file f (name or file object)
     and then produces ((sheet-name, org-name), row1, row2, ...)
     :param: f: file name or xlsx file object
+    :param: max_rows: maximum number of data rows per sheet or None
+    :param: max_columns: maximum number of data columns or None
+
+    Only the workbook manifest, styles and the form sheets before the
+    reference sheet are parsed, with shared strings parsed as far as
+    the highest one used. The reference and error checking sheets are
+    never read, so load time doesn't grow with them.
+
+    Cell values are converted the same way as openpyxl: numbers with a
+    date format become datetimes and formula cells produce the formula.
 
     :return: Generator that opens the excel file f
     and then produces:
@@ -21,42 +60,433 @@ def read_excel(f, file_contents=None):
         ...
     :rtype: generator
     """
-    wb = openpyxl.load_workbook(f, read_only=True)
+    try:
+        zf = zipfile.ZipFile(f)
+    except zipfile.BadZipfile:
+        raise BadExcelData(_('The file uploaded is not a valid Excel file'))
+
+    workbook_path = _first_target(_relationships(zf, ''), OFFICE_DOCUMENT_REL)
+    workbook_rels = _relationships(zf, workbook_path)
+    shared_strings = _SharedStrings(
+        zf, _first_target(workbook_rels, SHARED_STRINGS_REL))
+    sheet_paths = dict(
+        (rel_id, path)
+        for rels in workbook_rels.values()
+        for rel_id, path in rels.items())
+
+    root = ElementTree.fromstring(zf.read(workbook_path))
+    workbook_pr = root.find(SHEET_NS + 'workbookPr')
+    epoch = CALENDAR_WINDOWS_1900
+    if workbook_pr is not None and workbook_pr.get('date1904') in (
+            '1', 'true'):
+        epoch = CALENDAR_MAC_1904
+    date_styles, timedelta_styles = _date_styles(
+        zf, _first_target(workbook_rels, STYLES_REL))
+
+    def cell_value(c):
+        return _cell_value(
+            c, shared_strings, date_styles, timedelta_styles, epoch)
 
-    for sheetname in wb.sheetnames:
+    for sheet in root.iter(SHEET_NS + 'sheet'):
+        sheetname = sheet.get('name')
         if sheetname == 'reference':
             return
-        sheet = wb[sheetname]
-        rowiter = sheet.rows
-        header_row = next(rowiter)
+        rows = _sheet_rows(
+            zf,
+            sheet_paths[sheet.get(DOC_REL_NS + 'id')],
+            cell_value,
+            max_columns)
 
-        label_row = next(rowiter)
-        names_row = next(rowiter)
+        header = {}
+        first_data_row = None
+        for row_number, values in rows:
+            if row_number > HEADER_ROWS_V3:
+                first_data_row = (row_number, values)
+                break
+            header[row_number] = values
+        names_row = header.get(CODE_ROW, [])
+        example_row = header.get(EXAMPLE_ROW, [])
+        _check_template_rows(
+            names_row[0] if names_row else None,
+            example_row[0] if example_row else None)
 
-        if names_row[0].value != 'xlf_v1':
-            raise BadExcelData(_('Incorrect template version: {0}').format(names_row[0].value))
+        yield (
+            sheetname,
+            names_row[1] if len(names_row) > 1 else None,
+            names_row[DATA_FIRST_COL_NUM - 1:],
+            _filter_bumf(
+                _data_rows(
+                    chain([first_data_row] if first_data_row else [], rows),
+                    HEADER_ROWS_V3 + 1),
+                HEADER_ROWS_V3,
+                max_rows,
+                max_columns))
+
+
+def check_excel_size(f, max_bytes=None, max_uncompressed_bytes=None):
+    """
+    Raise BadExcelData if the excel file object f or the total size of
+    the parts it contains are larger than the limits given.
+
+    Uncompressed sizes are taken from the zip directory. zipfile refuses
+    to read more than the size recorded for a part, so this bounds the
+    XML that may be parsed later.
+    """
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(0)
+    if max_bytes and size > max_bytes:
+        raise BadExcelData(
+            _('The file uploaded is too large. The maximum size is '
+            '{0} bytes').format(max_bytes))
+    if not max_uncompressed_bytes:
+        return
+    try:
+        zf = zipfile.ZipFile(f)
+    except zipfile.BadZipfile:
+        raise BadExcelData(_('The file uploaded is not a valid Excel file'))
+    if sum(i.file_size for i in zf.infolist()) > max_uncompressed_bytes:
+        raise BadExcelData(
+            _('The file uploaded is too large. The maximum uncompressed '
+            'size is {0} bytes').format(max_uncompressed_bytes))
+    f.seek(0)
 
-        cstatus_row = next(rowiter)
-        example_row = next(rowiter)
-        if example_row[0].value != 'e.g.' and example_row[0].value != 'ex.':
-            raise BadExcelData(u'Example record on row 5 is missing')
+
+def read_excel_headers(f, max_columns=None):
+    """
+    Return a generator that reads only the workbook manifest and the
+    header rows of each form sheet of the excel file f. This is used to
+    reject uploads of the wrong template before reading any data.
+
+    :param: f: file name or seekable xlsx file object
+    :param: max_columns: maximum number of data columns or None
+
+    :return: Generator producing:
+        (sheet-name, resource-id, column_names)
+        ...
+    :rtype: generator
+    """
+    try:
+        zf = zipfile.ZipFile(f)
+    except zipfile.BadZipfile:
+        raise BadExcelData(_('The file uploaded is not a valid Excel file'))
+
+    workbook_path = _first_target(_relationships(zf, ''), OFFICE_DOCUMENT_REL)
+    workbook_rels = _relationships(zf, workbook_path)
+    shared_strings = _SharedStrings(
+        zf, _first_target(workbook_rels, SHARED_STRINGS_REL))
+    sheet_paths = dict(
+        (rel_id, path)
+        for rels in workbook_rels.values()
+        for rel_id, path in rels.items())
+
+    root = ElementTree.fromstring(zf.read(workbook_path))
+    for sheet in root.iter(SHEET_NS + 'sheet'):
+        sheetname = sheet.get('name')
+        if sheetname == 'reference':
+            return
+        rows = _read_header_rows(
+            zf, sheet_paths[sheet.get(DOC_REL_NS + 'id')], HEADER_ROWS_V3)
+        names_row = [
+            shared_strings.resolve(v) for v in rows.get(CODE_ROW, [])]
+        example_row = [
+            shared_strings.resolve(v) for v in rows.get(EXAMPLE_ROW, [])]
+        _check_template_rows(
+            names_row[0] if names_row else None,
+            example_row[0] if example_row else None)
+
+        _check_columns_limit(len(names_row) - DATA_FIRST_COL_NUM + 1, max_columns)
 
         yield (
             sheetname,
-            names_row[1].value,
-            [c.value for c in names_row[2:]],
-            _filter_bumf((row[2:] for row in rowiter), HEADER_ROWS_V3))
+            names_row[1] if len(names_row) > 1 else None,
+            names_row[2:])
+
+
+def _check_template_rows(version, example):
+    """
+    Raise BadExcelData if the template version code or the example
+    record marker is not what we expect
+    """
+    if version != 'xlf_v1':
+        raise BadExcelData(
+            _('Incorrect template version: {0}').format(version))
+    if example != 'e.g.' and example != 'ex.':
+        raise BadExcelData(u'Example record on row 5 is missing')
+
+
+def _check_columns_limit(columns, max_columns):
+    if max_columns and columns > max_columns:
+        raise BadExcelData(
+            _('The file uploaded has too many columns. The maximum is '
+            '{0}').format(max_columns))
+
+
+def _relationships(zf, part_path):
+    """
+    Return {relationship type: {relationship id: part name}} for the
+    relationships of an xlsx package part ('' for the package itself)
+    """
+    base_dir = posixpath.dirname(part_path)
+    rels_path = posixpath.join(
+        base_dir, '_rels', posixpath.basename(part_path) + '.rels')
+    root = ElementTree.fromstring(zf.read(rels_path))
+    rels = {}
+    for rel in root.iter(PKG_REL_NS + 'Relationship'):
+        target = rel.get('Target')
+        if target.startswith('/'):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join(base_dir, target))
+        rels.setdefault(rel.get('Type'), {})[rel.get('Id')] = target
+    return rels
+
+
+def _first_target(rels, rel_type):
+    for target in rels.get(rel_type, {}).values():
+        return target
+
+
+def _read_header_rows(zf, sheet_path, header_rows):
+    """
+    Stream through a worksheet part and return the raw cell values of
+    the first header_rows rows as {row_number: [value, ...]}, stopping
+    as soon as a later row is reached.
+
+    Shared string cells are returned as _SharedStringIndex values to be
+    resolved later.
+    """
+    rows = {}
+    for row_number, values in _sheet_rows(zf, sheet_path, _raw_cell_value):
+        if row_number > header_rows:
+            break
+        rows[row_number] = values
+    return rows
+
+
+def _sheet_rows(zf, sheet_path, cell_value, max_columns=None):
+    """
+    Stream through a worksheet part producing (row_number, values) for
+    each row in the file, where values are cell_value(c) for each cell
+    in the row, with None for missing cells.
+
+    Rows are discarded once parsed so memory use doesn't grow with the
+    sheet. The sheet dimensions, when recorded, are checked against
+    max_columns before any rows are read.
+    """
+    row_number = 0
+    sheet_data = None
+    with zf.open(sheet_path) as stream:
+        for event, elem in ElementTree.iterparse(stream, ('start', 'end')):
+            if event == 'start':
+                if elem.tag == SHEET_NS + 'sheetData':
+                    sheet_data = elem
+                continue
+            if elem.tag == SHEET_NS + 'dimension':
+                _check_dimension(elem.get('ref'), max_columns)
+                continue
+            if elem.tag != SHEET_NS + 'row':
+                continue
+            # row and cell references are optional in the file format
+            row_number = int(elem.get('r', row_number + 1))
+            values = []
+            for c in elem.iter(SHEET_NS + 'c'):
+                col_num = len(values) + 1
+                if c.get('r'):
+                    col_num = column_index_from_string(
+                        CELL_REF_RE.match(c.get('r')).group(1))
+                while len(values) < col_num - 1:
+                    values.append(None)
+                values.append(cell_value(c))
+            yield row_number, values
+            if sheet_data is not None:
+                sheet_data.clear()
+
+
+def _check_dimension(ref, max_columns):
+    """
+    Check the last column of a dimension reference like A1:K100
+    against max_columns
+    """
+    if not ref or not max_columns:
+        return
+    m = CELL_REF_RE.match(ref.split(':')[-1])
+    if m:
+        _check_columns_limit(
+            column_index_from_string(m.group(1)) - DATA_FIRST_COL_NUM + 1,
+            max_columns)
+
+
+def _data_rows(rows, first_row_number):
+    """
+    Return the data cell values for (row_number, values) rows, with
+    empty rows for rows missing from the file so that row numbers are
+    counted correctly
+    """
+    expected = first_row_number
+    for row_number, values in rows:
+        while expected < row_number:
+            yield []
+            expected += 1
+        yield values[DATA_FIRST_COL_NUM - 1:]
+        expected += 1
+
+
+def _date_styles(zf, styles_path):
+    """
+    Return (date_styles, timedelta_styles): sets of cell style indexes
+    with a date or time format, as openpyxl reads them
+    """
+    date_styles = set()
+    timedelta_styles = set()
+    if not styles_path:
+        return date_styles, timedelta_styles
+    root = ElementTree.fromstring(zf.read(styles_path))
+    custom = dict(
+        (int(n.get('numFmtId')), n.get('formatCode'))
+        for n in root.iter(SHEET_NS + 'numFmt'))
+    cell_xfs = root.find(SHEET_NS + 'cellXfs')
+    if cell_xfs is None:
+        return date_styles, timedelta_styles
+    for i, xf in enumerate(cell_xfs.iter(SHEET_NS + 'xf')):
+        num_fmt_id = int(xf.get('numFmtId', 0))
+        fmt = custom.get(num_fmt_id) or builtin_format_code(num_fmt_id)
+        if is_date_format(fmt):
+            date_styles.add(i)
+        if is_timedelta_format(fmt):
+            timedelta_styles.add(i)
+    return date_styles, timedelta_styles
+
+
+def _cell_value(c, shared_strings, date_styles, timedelta_styles, epoch):
+    """
+    Return the value of a cell element converted like openpyxl does
+    """
+    f = c.find(SHEET_NS + 'f')
+    if f is not None:
+        return u'=' + (f.text or u'')
+    cell_type = c.get('t', 'n')
+    if cell_type == 'inlineStr':
+        text = c.find(SHEET_NS + 'is')
+        return None if text is None else _shared_string_text(text)
+    value = c.findtext(SHEET_NS + 'v') or None
+    if value is None:
+        return None
+    if cell_type == 'n':
+        value = _cast_number(value)
+        style = int(c.get('s', 0))
+        if style in date_styles:
+            try:
+                return from_excel(
+                    value, epoch, timedelta=style in timedelta_styles)
+            except (OverflowError, ValueError):
+                return u'#VALUE!'
+        return value
+    if cell_type == 's':
+        return shared_strings.resolve(_SharedStringIndex(value))
+    if cell_type == 'b':
+        return bool(int(value))
+    if cell_type == 'd':
+        return from_ISO8601(value)
+    return value
+
+
+def _cast_number(value):
+    if '.' in value or 'E' in value or 'e' in value:
+        return float(value)
+    return int(value)
+
+
+def _raw_cell_value(c):
+    cell_type = c.get('t')
+    if cell_type == 'inlineStr':
+        return u''.join(t.text or u'' for t in c.iter(SHEET_NS + 't'))
+    v = c.find(SHEET_NS + 'v')
+    if v is None or v.text is None:
+        return None
+    if cell_type == 's':
+        return _SharedStringIndex(v.text)
+    return v.text
+
+
+class _SharedStringIndex(int):
+    pass
+
+
+class _SharedStrings(object):
+    """
+    Shared strings table, parsed only as far as the highest index
+    requested so far
+    """
+    def __init__(self, zf, path):
+        self._strings = []
+        self._iter = None
+        if path:
+            self._stream = zf.open(path)
+            self._iter = ElementTree.iterparse(self._stream)
+
+    def resolve(self, value):
+        if not isinstance(value, _SharedStringIndex):
+            return value
+        while self._iter is not None and len(self._strings) <= value:
+            try:
+                event, elem = next(self._iter)
+            except StopIteration:
+                self._iter = None
+                self._stream.close()
+                break
+            if elem.tag == SHEET_NS + 'si':
+                # as openpyxl reads them
+                self._strings.append(
+                    _shared_string_text(elem).replace('x005F_', ''))
+                elem.clear()
+        if value >= len(self._strings):
+            raise BadExcelData(_('The file uploaded is not a valid Excel file'))
+        return self._strings[value]
+
+
+def _shared_string_text(si):
+    """
+    Plain text of a shared string item, ignoring phonetic runs
+    """
+    t = si.find(SHEET_NS + 't')
+    if t is not None:
+        return t.text or u''
+    return u''.join(
+        t.text or u'' for t in si.iterfind(SHEET_NS + 'r/' + SHEET_NS + 't'))
+
 
+def _filter_bumf(rowiter, header_rows, max_rows=None, max_columns=None):
+    return filter_rows(
+        ([
+            unescape(v) if isinstance(v, text_type) else v
+            for v in row]
+        for row in rowiter),
+        header_rows,
+        max_rows,
+        max_columns)
 
-def _filter_bumf(rowiter, header_rows):
+
+def filter_rows(rowiter, header_rows, max_rows=None, max_columns=None):
+    """
+    Return a generator producing (row_number, values) for each non-empty
+    row of cell values in rowiter, enforcing the row and column limits
+
+    :param rowiter: iterable of lists of cell values
+    :param header_rows: number of rows read before rowiter
+    """
     i = header_rows
-    for row in rowiter:
+    num_rows = 0
+    for values in rowiter:
         i += 1
-        values = [
-            unescape(c.value) if isinstance(c.value, text_type) else c.value
-            for c in row]
+        _check_columns_limit(len(values), max_columns)
         # return next non-empty row
         if not all(_is_bumf(v) for v in values):
+            num_rows += 1
+            if max_rows and num_rows > max_rows:
+                raise BadExcelData(
+                    _('The file uploaded has too many rows. The maximum '
+                    'is {0}').format(max_rows))
             yield i, values
 
 
@@ -75,7 +505,8 @@ def _is_bumf(value):
     return value is None
 
 
-def get_records(rows, fields, primary_key_fields, choice_fields):
+def get_records(rows, fields, primary_key_fields, choice_fields,
+        validators=()):
     """
     Truncate/pad empty/missing records to expected row length, canonicalize
     cell content, and return resulting record list.
@@ -86,13 +517,15 @@ def get_records(rows, fields, primary_key_fields, choice_fields):
     :type fields: list or tuple
     :param primary_key_fields: list of field ids making up the PK
     :type primary_key_fields: list of strings
-    :param choice_fields: {field_id: 'full'/True/False}
+    :param choice_fields: {field_id: ChoiceField} for choice fields
     :type choice_fields: dict
+    :param validators: [(field_id, check), ...] from get_validators
+    :type validators: list
 
     :return: canonicalized records of specified upload data
-    :rtype: tuple of dicts
+    :rtype: Records
     """
-    records = []
+    records = Records(f['id'] for f in fields)
     for n, row in rows:
         # trailing cells might be empty: trim row to fit
         while (row and
@@ -103,21 +536,102 @@ def get_records(rows, fields, primary_key_fields, choice_fields):
             row.append(None) # placeholder: canonicalize once only, below
 
         try:
-            records.append(
-                (n, dict((
-                    f['id'],
-                    canonicalize(
-                        v,
-                        f['type'],
-                        f['id'] in primary_key_fields,
-                        choice_fields.get(f['id'], False)))
-                for f, v in zip(fields, row))))
+            values = tuple(
+                _canonicalize_field(
+                    v, f, f['id'] in primary_key_fields, choice_fields)
+                for f, v in zip(fields, row))
+            if validators:
+                record = dict(zip(records.field_ids, values))
+                for field_id, check in validators:
+                    error = check(record)
+                    if error:
+                        raise BadExcelData(error)
+            records.append(n, values)
         except BadExcelData as e:
-            raise BadExcelData(u'Row {0}:'.format(n) + u' ' + e.message)
+            raise BadExcelData(u'Row {0}:'.format(n) + u' ' + e.message, row=n)
 
     return records
 
 
+class Records(object):
+    """
+    Canonicalized records stored as one tuple of values per row sharing
+    a single tuple of field ids, with record dicts only created when
+    they are requested, e.g. for the datastore_upsert call.
+
+    Iterating or indexing produces (row_number, record_dict) pairs.
+    """
+    __slots__ = ('field_ids', 'row_numbers', 'values')
+
+    def __init__(self, field_ids):
+        self.field_ids = tuple(field_ids)
+        self.row_numbers = array('l')
+        self.values = []
+
+    def append(self, row_number, values):
+        self.row_numbers.append(row_number)
+        self.values.append(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.row_numbers[i], dict(zip(self.field_ids, self.values[i]))
+
+    def __iter__(self):
+        for n, values in zip(self.row_numbers, self.values):
+            yield n, dict(zip(self.field_ids, values))
+
+    def duplicate_keys(self, key_fields):
+        """
+        Return [(row_number, first_row_number), ...] for records with the
+        same key_fields values as an earlier record, in a single pass
+        """
+        positions = [self.field_ids.index(f) for f in key_fields]
+        seen = {}
+        duplicates = []
+        for n, values in zip(self.row_numbers, self.values):
+            key = tuple(_hashable(values[i]) for i in positions)
+            first = seen.setdefault(key, n)
+            if first != n:
+                duplicates.append((n, first))
+        return duplicates
+
+    def sort(self, key):
+        """
+        Sort records in place by key(values), keeping their row numbers
+        """
+        values = self.values
+        order = sorted(range(len(values)), key=lambda i: key(values[i]))
+        self.values = [values[i] for i in order]
+        self.row_numbers = array('l', (self.row_numbers[i] for i in order))
+
+    def dicts(self, start=0, end=None):
+        """
+        Return a list of record dicts for passing to the datastore,
+        optionally only for rows start to end
+        """
+        field_ids = self.field_ids
+        return [
+            dict(zip(field_ids, values)) for values in self.values[start:end]]
+
+
+def _hashable(value):
+    # _text values are lists
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _canonicalize_field(value, field, primary_key, choice_fields):
+    choice_field = choice_fields.get(field['id'])
+    if choice_field is None:
+        return canonicalize(value, field['type'], primary_key)
+    return canonicalize(
+        value,
+        field['type'],
+        primary_key,
+        'full' if choice_field.full_text else True)
+
+
 # XXX remove this function once we upgrade to openpyxl 2.4
 def unescape(value):
     """
@@ -0,0 +1,104 @@
+import simplejson as json
+from six import string_types
+
+from ckan.plugins.toolkit import _
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.read_excel import filter_rows
+
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+NDJSON_CONTENT_TYPES = (
+    'application/x-ndjson',
+    'application/jsonl',
+    'application/json-lines',
+)
+
+
+def is_ndjson(filename, content_type=None):
+    """
+    Return True if an uploaded file is newline-delimited JSON
+    """
+    return content_type in NDJSON_CONTENT_TYPES or (
+        (filename or '').lower().endswith(NDJSON_EXTENSIONS))
+
+
+def read_ndjson(f, resource_id, expected_columns, max_rows=None,
+        max_bytes=None):
+    """
+    Return a generator that reads the file object f containing one JSON
+    object per line, keyed by datastore column id, and produces rows in
+    the same form as read_excel. Missing keys are treated as blank
+    cells and lists are joined with commas like _text cells.
+
+    :param: f: file object producing lines of UTF-8 JSON
+    :param: resource_id: resource the file is being uploaded to
+    :param: expected_columns: datastore column ids in data dictionary order
+    :param: max_rows: maximum number of data rows or None
+    :param: max_bytes: maximum size of the file or None, checked as it
+        is read because streamed request bodies may not declare a size
+
+    :return: Generator that produces:
+        (sheet-name, resource-id, column_names, data_rows_generator)
+    :rtype: generator
+    """
+    yield (
+        'ndjson',
+        resource_id,
+        list(expected_columns),
+        filter_rows(
+            _ndjson_rows(_lines(f, max_bytes), expected_columns),
+            0,
+            max_rows))
+
+
+def _lines(f, max_bytes):
+    size = 0
+    while True:
+        # never read more than one byte past the limit, even for a
+        # single line
+        line = f.readline(max_bytes - size + 1 if max_bytes else -1)
+        if not line:
+            return
+        size += len(line)
+        if max_bytes and size > max_bytes:
+            raise BadExcelData(
+                _('The file uploaded is too large. The maximum size is '
+                '{0} bytes').format(max_bytes))
+        yield line
+
+
+def _ndjson_rows(lines, expected_columns):
+    expected = set(expected_columns)
+    for n, line in enumerate(lines, 1):
+        if not line.strip():
+            yield []
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            raise BadExcelData(
+                _(u'Row {0}: invalid JSON').format(n), row=n)
+        if not isinstance(obj, dict):
+            raise BadExcelData(
+                _(u'Row {0}: expected a JSON object').format(n), row=n)
+        unknown = set(obj) - expected
+        if unknown:
+            raise BadExcelData(
+                _(u'Row {0}: unknown column ids: {1}').format(
+                    n, u', '.join(sorted(unknown))),
+                row=n)
+        yield [_cell_value(obj.get(c), n) for c in expected_columns]
+
+
+def _cell_value(value, n):
+    if isinstance(value, list):
+        if not all(isinstance(v, string_types) for v in value):
+            raise BadExcelData(
+                _(u'Row {0}: lists may only contain strings').format(n),
+                row=n)
+        return u','.join(value)
+    if isinstance(value, dict):
+        raise BadExcelData(
+            _(u'Row {0}: nested objects are not supported').format(n),
+            row=n)
+    return value
@@ -0,0 +1,65 @@
+"""
+Spooling uploads to temporary files, so they are read through the page
+cache instead of held in memory and can be opened by name from worker
+processes
+"""
+
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+from ckan.plugins.toolkit import _, config
+
+from ckanext.excelforms.errors import BadExcelData
+
+SPOOL_BLOCK_SIZE = 1024 * 1024
+
+
+@contextmanager
+def spooled_upload(upload_file, max_bytes=None, on_disk=False):
+    """
+    Context manager returning (f, sha256) for upload_file copied to a
+    temporary file in ckanext.excelforms.spool_dir, hashed as it is
+    written. upload_file only needs a read method, e.g. a FileStorage
+    or a request stream, and is read from its current position. The
+    temporary file is removed on exit.
+
+    Pass on_disk=True for regular files opened by name, like completed
+    chunked uploads: they are hashed and used in place instead.
+
+    raises BadExcelData when upload_file is larger than max_bytes.
+    """
+    if on_disk:
+        yield upload_file, file_sha256(upload_file)
+        return
+
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(
+            dir=config.get('ckanext.excelforms.spool_dir') or None,
+            prefix='excelforms-',
+            suffix='.upload') as f:
+        for block in iter(lambda: upload_file.read(SPOOL_BLOCK_SIZE), b''):
+            size += len(block)
+            if max_bytes and size > max_bytes:
+                raise BadExcelData(
+                    _('The file uploaded is too large. The maximum size is '
+                    '{0} bytes').format(max_bytes))
+            digest.update(block)
+            f.write(block)
+        f.flush()
+        f.seek(0)
+        yield f, digest.hexdigest()
+
+
+def file_sha256(f):
+    """
+    Return the sha256 hex digest of seekable file f, leaving it at
+    the start of the file
+    """
+    digest = hashlib.sha256()
+    f.seek(0)
+    for block in iter(lambda: f.read(SPOOL_BLOCK_SIZE), b''):
+        digest.update(block)
+    f.seek(0)
+    return digest.hexdigest()
@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+import shutil
+import tempfile
+import threading
+import time
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.excelforms.cache import (
+    SingleFlight, FileCache, fingerprint, _build_cached)
+
+
+def test_fingerprint():
+    assert_equal(
+        fingerprint({'a': 1, 'b': [2]}, 'en'),
+        fingerprint({'b': [2], 'a': 1}, 'en'))
+    assert fingerprint({'a': 1}, 'en') != fingerprint({'a': 1}, 'fr')
+
+
+def test_single_flight_shares_result():
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def build():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do('k', build)))
+        for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert_equal(len(calls), 1)
+    assert_equal(results, ['result'] * 5)
+
+
+def test_single_flight_error():
+    flight = SingleFlight()
+
+    def build():
+        raise ValueError('nope')
+
+    assert_raises(ValueError, flight.do, 'k', build)
+    assert_equal(flight.do('k', lambda: 'ok'), 'ok')
+
+
+
+class _LeaderBusy(Exception):
+    pass
+
+
+def test_single_flight_retry_errors_not_shared():
+    flight = SingleFlight()
+    started = threading.Event()
+    calls = []
+    results = []
+
+    def leader_build():
+        calls.append('leader')
+        started.set()
+        time.sleep(0.2)
+        raise _LeaderBusy()
+
+    def waiter_build():
+        calls.append('waiter')
+        return 'result'
+
+    def waiter():
+        started.wait()
+        results.append(flight.do('k', waiter_build, retry=(_LeaderBusy,)))
+
+    threads = [threading.Thread(target=waiter) for i in range(3)]
+    for t in threads:
+        t.start()
+    assert_raises(
+        _LeaderBusy, flight.do, 'k', leader_build, retry=(_LeaderBusy,))
+    for t in threads:
+        t.join()
+    assert_equal(results, ['result'] * 3)
+    assert_equal(calls[0], 'leader')
+    assert 1 <= calls.count('waiter') <= 3
+
+def test_file_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = FileCache(cache_dir, '.xlsx')
+        calls = []
+
+        def build():
+            calls.append(1)
+            return b'data'
+
+        assert_equal(_build_cached(cache, 'res-en', 'k1', build), b'data')
+        assert_equal(_build_cached(cache, 'res-en', 'k1', build), b'data')
+        assert_equal(len(calls), 1)
+        cache.set('res-en', 'k2', b'new')
+        assert_equal(cache.get('res-en', 'k1'), None)
+        assert_equal(cache.get('res-en', 'k2'), b'new')
+    finally:
+        shutil.rmtree(cache_dir)
@@ -3,7 +3,8 @@ from datetime import datetime, date
 
 from nose.tools import assert_raises, assert_equal
 
-from ckanext.recombinant.datatypes import canonicalize, BadExcelData
+from ckanext.excelforms.datatypes import canonicalize
+from ckanext.excelforms.errors import BadExcelData
 
 def test_year():
     dt = 'year'
@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.excelforms.choices import (
+    get_choice_fields, field_choices, invalid_choices)
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.read_excel import get_records
+from ckanext.excelforms.validation import get_validators
+
+DD = [
+    {'id': '_id', 'type': 'int'},
+    {'id': 'status', 'type': 'text', 'info': {
+        'excelforms_choices': u'A: Active\nI: Inactive\n\nA: Again'}},
+    {'id': 'kind', 'type': 'text', 'info': {
+        'excelforms_choices': [['X', 'Ex'], ['Y', 'Why']],
+        'excelforms_full_text_choices': 'true'}},
+    {'id': 'tags', 'type': '_text', 'info': {
+        'excelforms_choices': ['t1', 't2']}},
+    {'id': 'notes', 'type': 'text', 'info': {}},
+]
+
+
+def test_field_choices():
+    assert_equal(
+        field_choices({'excelforms_choices': u'A: Active\n B \n'}),
+        [(u'A', u'Active'), (u'B', u'B')])
+    assert_equal(
+        field_choices({'excelforms_choices': {'A': 'Active'}}),
+        [(u'A', u'Active')])
+    assert_equal(field_choices({}), [])
+
+
+def test_field_choices_skips_invalid_entries():
+    assert_equal(
+        field_choices({'excelforms_choices': [
+            ['a', 'b', 'c'], 1, {'a': 1}, ['B', 'Bee'], [None, 'x'], 'C']}),
+        [(u'1', u'1'), (u'B', u'Bee'), (u'C', u'C')])
+    assert_equal(
+        field_choices({'excelforms_choices': {'A': ['x'], 'B': 2}}),
+        [(u'B', u'2')])
+    assert_equal(field_choices({'excelforms_choices': 5}), [])
+
+
+def test_get_choice_fields():
+    choice_fields = get_choice_fields(DD)
+    assert_equal(list(choice_fields), ['status', 'kind', 'tags'])
+    assert_equal(choice_fields['status'].valid_keys, u'A, I')
+    assert_equal(choice_fields['kind'].full_text, True)
+    assert_equal(
+        choice_fields['kind'].ref_rows,
+        [('choice', [u'X: Ex']), ('choice', [u'Y: Why'])])
+    assert_equal(choice_fields['tags'].full_text, False)
+    assert get_choice_fields(list(DD)) is choice_fields
+
+
+def test_invalid_choices():
+    status = get_choice_fields(DD)['status']
+    assert_equal(invalid_choices(status, u'A'), [])
+    assert_equal(invalid_choices(status, None), [])
+    assert_equal(invalid_choices(status, u'Z'), [u'Z'])
+    assert_equal(invalid_choices(status, [u'A', u'Z']), [u'Z'])
+
+
+def test_get_records_choices():
+    fields = DD[1:]
+    choice_fields = get_choice_fields(DD)
+    validators = get_validators(DD)
+    records = get_records(
+        [(6, [u' A', u'X: Ex', u't1, t2', u'anything'])],
+        fields, [], choice_fields, validators)
+    assert_equal(list(records), [(6, {
+        'status': u'A', 'kind': u'X', 'tags': [u't1', u't2'],
+        'notes': u'anything'})])
+    assert_raises(
+        BadExcelData, get_records,
+        [(6, [u'A', u'Z: Zed', None, None])], fields, [], choice_fields,
+        validators)
+    assert_raises(
+        BadExcelData, get_records,
+        [(6, [u'A', None, u't1,t3', None])], fields, [], choice_fields,
+        validators)
@@ -0,0 +1,107 @@
+# -*- coding: UTF-8 -*-
+import os
+import hashlib
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.excelforms.chunked import ChunkedUploads, add_range
+from ckanext.excelforms.errors import BadExcelData
+
+
+def test_add_range():
+    assert_equal(add_range([], 10, 20), [[10, 20]])
+    assert_equal(add_range([[0, 10], [20, 30]], 10, 20), [[0, 30]])
+    assert_equal(add_range([[0, 10]], 5, 8), [[0, 10]])
+
+
+def test_chunked_upload_resume():
+    upload_dir = tempfile.mkdtemp()
+    uploads = ChunkedUploads(upload_dir)
+    try:
+        data = b'0123456789' * 10
+        upload_id = uploads.create(
+            'res-1', 'joe', len(data),
+            sha256=hashlib.sha256(data).hexdigest())['upload_id']
+        status = uploads.write(upload_id, 'res-1', 'joe', 60, data[60:])
+        assert_equal(status['received'], [[60, 100]])
+        assert not status['complete']
+        assert_raises(
+            BadExcelData, lambda: uploads.open(
+                upload_id, 'res-1', 'joe').__enter__())
+
+        status = uploads.write(
+            upload_id, 'res-1', 'joe', 0, data[:60],
+            hashlib.sha256(data[:60]).hexdigest())
+        assert status['complete']
+        with uploads.open(upload_id, 'res-1', 'joe') as f:
+            assert_equal(f.read(), data)
+    finally:
+        shutil.rmtree(upload_dir)
+
+
+def test_chunked_upload_checks():
+    upload_dir = tempfile.mkdtemp()
+    uploads = ChunkedUploads(upload_dir)
+    try:
+        upload_id = uploads.create('res-1', 'joe', 10)['upload_id']
+        assert_raises(
+            BadExcelData, uploads.write,
+            upload_id, 'res-1', 'joe', 0, b'abc', 'bad')
+        assert_raises(
+            BadExcelData, uploads.write,
+            upload_id, 'res-1', 'joe', 8, b'abc')
+        assert_raises(
+            BadExcelData, uploads.get, upload_id, 'res-1', 'sam')
+        assert_raises(
+            BadExcelData, uploads.get, '../x', 'res-1', 'joe')
+        assert_raises(
+            BadExcelData, uploads.create, 'res-1', 'joe', 10,
+            max_bytes=5)
+    finally:
+        shutil.rmtree(upload_dir)
+
+
+def test_failed_completion_keeps_upload():
+    upload_dir = tempfile.mkdtemp()
+    uploads = ChunkedUploads(upload_dir)
+    try:
+        upload_id = uploads.create('res-1', 'joe', 3)['upload_id']
+        uploads.write(upload_id, 'res-1', 'joe', 0, b'abc')
+
+        def fail(f):
+            raise BadExcelData('try again')
+        assert_raises(
+            BadExcelData, uploads.complete,
+            upload_id, 'res-1', 'joe', fail)
+        assert_equal(
+            uploads.complete(
+                upload_id, 'res-1', 'joe', lambda f: f.read(), keep=True),
+            b'abc')
+        assert_equal(
+            uploads.complete(upload_id, 'res-1', 'joe', lambda f: f.read()),
+            b'abc')
+        assert_raises(BadExcelData, uploads.get, upload_id, 'res-1', 'joe')
+    finally:
+        shutil.rmtree(upload_dir)
+
+
+def test_uploads_per_user_and_expiry():
+    upload_dir = tempfile.mkdtemp()
+    uploads = ChunkedUploads(upload_dir, max_per_user=2)
+    try:
+        first = uploads.create('res-1', 'joe', 10)['upload_id']
+        uploads.create('res-1', 'joe', 10)
+        assert_raises(BadExcelData, uploads.create, 'res-1', 'joe', 10)
+        uploads.create('res-1', 'sam', 10)
+        uploads.remove(first)
+        uploads.create('res-1', 'joe', 10)
+
+        expiring = ChunkedUploads(upload_dir, expiry=-1)
+        sam = expiring.create('res-1', 'sam', 10)['upload_id']
+        assert_raises(
+            BadExcelData, expiring.write, sam, 'res-1', 'sam', 0, b'a')
+        assert_equal(os.listdir(upload_dir), ['create.lock'])
+    finally:
+        shutil.rmtree(upload_dir)
@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+"""
+The tests loading a real datastore table are skipped unless
+EXCELFORMS_TEST_DATASTORE_URL is set to a PostgreSQL database URL
+they can create tables in, e.g. a copy of ckan.datastore.write_url.
+"""
+import os
+import uuid
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest import mock, SkipTest
+
+import psycopg2
+import sqlalchemy as sa
+from nose.tools import assert_equal, assert_raises
+
+from ckan.logic import ValidationError
+from ckan.plugins.toolkit import config
+
+from ckanext.excelforms import datastore
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.datastore import (
+    CopyStream, copy_line, sort_by_key, transaction)
+from ckanext.excelforms.read_excel import Records
+
+
+def test_copy_line():
+    assert_equal(
+        copy_line(
+            [u'a "b"', u'', u'', None, [u'x', u'y"z'], u'é'],
+            ['text', 'text', 'int', 'date', '_text', 'text']),
+        u'"a ""b""","",,,"{""x"",""y\\""z""}","é"\n'.encode('utf-8'))
+
+
+def test_copy_stream():
+    records = Records(['a'])
+    for n in range(100):
+        records.append(n, (u'%d' % n,))
+    stream = CopyStream(records, ['int'])
+    chunks = []
+    while True:
+        data = stream.read(7)
+        if not data:
+            break
+        assert len(data) <= 7
+        chunks.append(data)
+    assert_equal(
+        b''.join(chunks),
+        b''.join(b'"%d"\n' % n for n in range(100)))
+
+
+def test_sort_by_key():
+    records = Records(['code', 'year', 'name'])
+    for n, values in enumerate([
+            (u'b', u'10', u'w'),
+            (u'a', u'10', u'x'),
+            (u'b', u'9', u'y'),
+            (u'a', u'', u'z')]):
+        records.append(n + 6, values)
+    sort_by_key(
+        records,
+        [{'id': 'code', 'type': 'text'}, {'id': 'year', 'type': 'int'}],
+        ['code', 'year'])
+    assert_equal(list(records.row_numbers), [7, 9, 8, 6])
+    assert_equal([v[2] for v in records.values], [u'x', u'z', u'y', u'w'])
+
+
+def test_duplicate_keys():
+    records = Records(['code', 'tags'])
+    for n, values in enumerate([
+            (u'a', [u'x']),
+            (u'b', [u'x']),
+            (u'a', [u'x']),
+            (u'a', [u'y']),
+            (u'a', [u'x'])]):
+        records.append(n + 6, values)
+    assert_equal(records.duplicate_keys(['code', 'tags']), [(8, 6), (10, 6)])
+    assert_equal(records.duplicate_keys(['tags']), [(7, 6), (8, 6), (10, 6)])
+
+
+@contextmanager
+def _datastore_table():
+    """
+    Yield (lc, resource_id, count) for a new datastore-like table with
+    a unique code column and an int column n, dropped afterwards
+    """
+    url = os.environ.get('EXCELFORMS_TEST_DATASTORE_URL')
+    if not url:
+        raise SkipTest(
+            'set EXCELFORMS_TEST_DATASTORE_URL to test with PostgreSQL')
+    resource_id = str(uuid.uuid4())
+    table = datastore.identifier(resource_id)
+    engine = sa.create_engine(url)
+    with engine.begin() as connection:
+        connection.execute(sa.text(
+            u'CREATE TABLE {0} (_id serial PRIMARY KEY, '
+            u'_full_text tsvector, code text, n int)'.format(table)))
+        connection.execute(sa.text(
+            u'CREATE UNIQUE INDEX ON {0} (code)'.format(table)))
+
+    def count():
+        with engine.connect() as connection:
+            return connection.execute(sa.text(
+                u'SELECT count(*) FROM {0}'.format(table))).scalar()
+
+    lc = SimpleNamespace(
+        username='admin',
+        action=SimpleNamespace(datastore_upsert=mock.Mock()))
+    try:
+        with mock.patch.dict(config, {'ckan.datastore.write_url': url}), \
+                mock.patch.object(datastore, 'check_access'):
+            yield lc, resource_id, count
+    finally:
+        with engine.begin() as connection:
+            connection.execute(sa.text(u'DROP TABLE {0}'.format(table)))
+        engine.dispose()
+
+
+def _records(values):
+    records = Records(['code', 'n'])
+    for n, v in enumerate(values):
+        records.append(n + 6, v)
+    return records
+
+
+def test_transaction_batches_roll_back():
+    with _datastore_table() as (lc, resource_id, count):
+        records = _records([
+            (u'a', u'1'), (u'b', u'2'), (u'c', u'3'), (u'd', u'x'),
+            (u'e', u'5')])
+        with assert_raises(ValidationError) as cm:
+            with transaction(lc, False) as load:
+                load(resource_id, records, None, 'upsert', 2)
+        # second row of the second batch
+        assert_equal(cm.exception.error_dict['records_row'], 3)
+        assert_equal(count(), 0)
+        assert not lc.action.datastore_upsert.called
+
+
+def test_transaction_commit_and_dry_run():
+    with _datastore_table() as (lc, resource_id, count):
+        with transaction(lc, True) as load:
+            load(resource_id, _records([(u'a', u'1')]), None, 'upsert', 2)
+        assert_equal(count(), 0)
+
+        # records committed are kept when updating the resource fails
+        lc.action.datastore_upsert.side_effect = ValidationError({})
+        with transaction(lc, False) as load:
+            load(resource_id, _records([
+                (u'a', u'1'), (u'b', u'2'), (u'c', u'3')]), None,
+                'upsert', 2)
+        assert_equal(count(), 3)
+        lc.action.datastore_upsert.assert_called_once_with(
+            resource_id=resource_id, records=[], force=True)
+
+
+DD = [{'id': 'code', 'type': 'text'}, {'id': 'n', 'type': 'int'}]
+
+
+def test_copy_error_rows():
+    with _datastore_table() as (lc, resource_id, count):
+        records = _records([(u'a', u'1'), (u'b', u'2'), (u'c', u'x')])
+        with assert_raises(BadExcelData) as cm:
+            with transaction(lc, False) as load:
+                load(resource_id, records, DD, 'copy')
+        assert_equal(cm.exception.row, 8)
+        assert cm.exception.message.startswith(u'Row 8: '), \
+            cm.exception.message
+        assert_equal(count(), 0)
+
+        with transaction(lc, False) as load:
+            load(resource_id, _records([(u'a', u'1')]), DD, 'copy')
+        assert_equal(count(), 1)
+
+
+def _copy_error(context):
+    class CopyError(psycopg2.Error):
+        diag = SimpleNamespace(message_primary=u'bad value', context=context)
+
+    def copy_expert(sql, stream, size):
+        raise CopyError()
+
+    return SimpleNamespace(connection=SimpleNamespace(
+        cursor=lambda: SimpleNamespace(
+            copy_expert=copy_expert, close=lambda: None)))
+
+
+def test_copy_error_line_out_of_range():
+    records = _records([(u'a', u'1'), (u'b', u'2')])
+    with assert_raises(BadExcelData) as cm:
+        datastore._copy(
+            _copy_error(u'COPY t, line 2, column n'), 'res', records, DD)
+    assert_equal(cm.exception.row, 7)
+
+    for context in [u'COPY t, line 3', u'COPY t, line 0', None]:
+        with assert_raises(BadExcelData) as cm:
+            datastore._copy(_copy_error(context), 'res', records, DD)
+        assert_equal(cm.exception.row, None)
+        assert u'bad value' in cm.exception.message
@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+import os
+import time
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.excelforms.dedupe import UploadResults, deduplicated
+
+
+def test_duplicate_upload_not_processed():
+    cache_dir = tempfile.mkdtemp()
+    results = UploadResults(cache_dir, 60)
+    calls = []
+
+    def process():
+        calls.append(1)
+        return {'records': 3}
+
+    try:
+        assert_equal(
+            deduplicated(results, 'res-1', 'key-a', process),
+            {'records': 3})
+        assert_equal(
+            deduplicated(results, 'res-1', 'key-a', process),
+            {'records': 3, 'duplicate': True})
+        assert_equal(len(calls), 1)
+
+        # a different upload replaces the recorded one
+        deduplicated(results, 'res-1', 'key-b', process)
+        deduplicated(results, 'res-1', 'key-a', process)
+        assert_equal(len(calls), 3)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_failed_upload_not_recorded():
+    cache_dir = tempfile.mkdtemp()
+    results = UploadResults(cache_dir, 60)
+
+    def process():
+        raise ValueError()
+
+    try:
+        try:
+            deduplicated(results, 'res-1', 'key-a', process)
+        except ValueError:
+            pass
+        assert_equal(results.get('res-1', 'key-a'), None)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_result_expires_after_window():
+    cache_dir = tempfile.mkdtemp()
+    results = UploadResults(cache_dir, 60)
+    try:
+        results.set('res-1', 'key-a', {'records': 3})
+        assert_equal(results.get('res-1', 'key-a'), {'records': 3})
+        results.window = 0
+        time.sleep(0.01)
+        assert_equal(results.get('res-1', 'key-a'), None)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_duplicate_upload_in_other_process_waits():
+    cache_dir = tempfile.mkdtemp()
+    results = UploadResults(cache_dir, 60)
+    try:
+        assert_equal(results.claim('res-1', 'key-a'), None)
+        pid = os.fork()
+        if not pid:
+            # another web server process receiving the same upload
+            other = UploadResults(cache_dir, 60)
+            result = deduplicated(
+                other, 'res-1', 'key-a', lambda: {'records': 0})
+            os._exit(0 if result.get('duplicate') else 1)
+
+        # unrelated uploads don't wait
+        assert_equal(
+            deduplicated(results, 'res-1', 'key-b', lambda: {'records': 1}),
+            {'records': 1})
+        time.sleep(0.2)
+        results.set('res-1', 'key-a', {'records': 3})
+        results.release('res-1', 'key-a')
+        assert_equal(os.waitpid(pid, 0)[1], 0)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_stale_running_marker_ignored():
+    cache_dir = tempfile.mkdtemp()
+    results = UploadResults(cache_dir, 60, wait=0)
+    try:
+        # left behind by a process that died while loading
+        assert_equal(results.claim('res-1', 'key-a'), None)
+        assert_equal(
+            deduplicated(results, 'res-1', 'key-a', lambda: {'records': 1}),
+            {'records': 1})
+        assert not [n for n in os.listdir(cache_dir) if n.endswith('.running')]
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,34 @@
+"""
+Loading the plugin must not import the heavy dependencies only needed
+by excelforms requests, so CKAN CLI commands and job workers start
+quickly. Each check runs in a fresh interpreter.
+"""
+import sys
+import subprocess
+
+from nose.tools import assert_equal
+
+DEFERRED_MODULES = [
+    'openpyxl',
+    'ckanapi',
+    'ckanext.datastore.backend.postgres',
+    'ckanext.excelforms.read_excel',
+    'ckanext.excelforms.write_excel',
+    ]
+
+
+def _imported_after(module):
+    script = (
+        'import sys, {0}\n'
+        'print("\\n".join(m for m in {1!r} if m in sys.modules))\n'
+        ).format(module, DEFERRED_MODULES)
+    out = subprocess.check_output([sys.executable, '-c', script])
+    return out.decode('utf-8').split()
+
+
+def test_plugin_import_defers_heavy_modules():
+    assert_equal(_imported_after('ckanext.excelforms.plugins'), [])
+
+
+def test_blueprint_import_defers_heavy_modules():
+    assert_equal(_imported_after('ckanext.excelforms.blueprint'), [])
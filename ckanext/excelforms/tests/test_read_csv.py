@@ -0,0 +1,39 @@
+# -*- coding: UTF-8 -*-
+from io import BytesIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.read_csv import csv_delimiter, read_csv
+
+
+def _read(data, delimiter=',', **kwargs):
+    sheet, res_id, column_names, rows = next(read_csv(
+        BytesIO(data.encode('utf-8')), 'res-1', ['a', 'b'], delimiter,
+        **kwargs))
+    return column_names, list(rows)
+
+
+def test_csv_delimiter():
+    assert_equal(csv_delimiter('data.CSV'), ',')
+    assert_equal(csv_delimiter('data.tsv'), '\t')
+    assert_equal(csv_delimiter('upload', 'text/csv'), ',')
+    assert_equal(csv_delimiter('template.xlsx'), None)
+
+
+def test_read_csv():
+    assert_equal(
+        _read(u'﻿a,b\n1,é\n\n,\n3\n'),
+        (['a', 'b'], [(2, [u'1', u'é']), (5, [u'3', None])]))
+
+
+def test_read_tsv_reordered():
+    assert_equal(
+        _read(u'b\ta\n1\t2\n', '\t'),
+        (['a', 'b'], [(2, [u'2', u'1'])]))
+
+
+def test_read_csv_errors():
+    assert_raises(BadExcelData, _read, u'a,c\n1,2\n')
+    assert_raises(BadExcelData, _read, u'a,b\n1,2,3\n')
+    assert_raises(BadExcelData, _read, u'a,b\n1,2\n3,4\n', max_rows=1)
@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+from datetime import datetime
+from io import BytesIO
+
+import openpyxl
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.read_excel import (
+    read_excel, read_excel_headers, check_excel_size, get_records)
+
+
+def _upload_workbook(resource_id, column_names, rows=()):
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = 'form'
+    sheet.cell(row=1, column=3).value = 'Title'
+    sheet.cell(row=3, column=1).value = 'xlf_v1'
+    sheet.cell(row=3, column=2).value = resource_id
+    for col_num, name in enumerate(column_names, 3):
+        sheet.cell(row=3, column=col_num).value = name
+    sheet.cell(row=5, column=1).value = 'e.g.'
+    for row_num, row in enumerate(rows, 6):
+        for col_num, value in enumerate(row, 3):
+            sheet.cell(row=row_num, column=col_num).value = value
+    book.create_sheet('reference')
+    blob = BytesIO()
+    book.save(blob)
+    blob.seek(0)
+    return blob
+
+
+def test_read_excel_headers():
+    f = _upload_workbook('res-1', ['a', 'b', 'c'], [(1, 2, 3)] * 10)
+    assert_equal(
+        list(read_excel_headers(f)),
+        [('form', 'res-1', ['a', 'b', 'c'])])
+
+
+def test_read_excel_headers_matches_read_excel():
+    f = _upload_workbook('res-1', ['a', None, 'c'], [(1, 2, 3)])
+    headers = list(read_excel_headers(f))
+    f.seek(0)
+    assert_equal(
+        headers,
+        [(s, r, c) for (s, r, c, rows) in read_excel(f)])
+
+
+def test_max_rows():
+    f = _upload_workbook('res-1', ['a', 'b'], [(1, 2)] * 10)
+    sheetname, res_id, column_names, rows = next(read_excel(f, max_rows=10))
+    assert_equal(len(list(rows)), 10)
+    f.seek(0)
+    sheetname, res_id, column_names, rows = next(read_excel(f, max_rows=9))
+    assert_raises(BadExcelData, list, rows)
+
+
+def test_max_columns():
+    f = _upload_workbook('res-1', ['a', 'b', 'c'])
+    assert_raises(BadExcelData, list, read_excel_headers(f, max_columns=2))
+    f.seek(0)
+    assert_raises(BadExcelData, list, read_excel(f, max_columns=2))
+
+
+def test_read_excel_values():
+    f = _upload_workbook('res-1', ['a', 'b', 'c'], [
+        (u'x', 1, 2.5),
+        (datetime(2020, 3, 4), True, u'=SUM(A1)'),
+        (None, None, None),
+        (None, u'a_x000D_b', None),
+        ])
+    book = openpyxl.load_workbook(f)
+    book.create_sheet('e1').append([u'=A1'])
+    f = BytesIO()
+    book.save(f)
+    f.seek(0)
+    sheetname, res_id, column_names, rows = next(read_excel(f))
+    assert_equal(list(rows), [
+        (6, [u'x', 1, 2.5]),
+        (7, [datetime(2020, 3, 4), True, u'=SUM(A1)']),
+        (9, [None, u'a\rb']),
+        ])
+
+
+def test_check_excel_size():
+    f = _upload_workbook('res-1', ['a', 'b'], [(u'x' * 1000,)] * 100)
+    size = len(f.getvalue())
+    check_excel_size(f, size, size * 1000)
+    assert_raises(BadExcelData, check_excel_size, f, size - 1, None)
+    assert_raises(BadExcelData, check_excel_size, f, None, size)
+
+
+def test_get_records_compact():
+    fields = [{'id': 'a', 'type': 'text'}, {'id': 'b', 'type': 'int'}]
+    records = get_records(
+        [(6, [u'x', u'1']), (8, [u'y'])], fields, [], {})
+    assert_equal(records.field_ids, ('a', 'b'))
+    assert_equal(len(records), 2)
+    assert_equal(records[1], (8, {'a': u'y', 'b': None}))
+    assert_equal(records.dicts(), [
+        {'a': u'x', 'b': u'1'}, {'a': u'y', 'b': None}])
@@ -0,0 +1,47 @@
+# -*- coding: UTF-8 -*-
+from io import BytesIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.read_ndjson import is_ndjson, read_ndjson
+
+
+def _read(data):
+    sheet, res_id, column_names, rows = next(read_ndjson(
+        BytesIO(data.encode('utf-8')), 'res-1', ['a', 'b']))
+    return list(rows)
+
+
+def test_is_ndjson():
+    assert is_ndjson('records.ndjson')
+    assert is_ndjson(None, 'application/x-ndjson')
+    assert not is_ndjson('template.xlsx')
+
+
+def test_read_ndjson():
+    assert_equal(
+        _read(u'{"a": 1, "b": ["x", "y"]}\n\n{"b": "é"}\n'),
+        [(1, [1, u'x,y']), (3, [None, u'é'])])
+
+
+def test_read_ndjson_errors():
+    for data in [u'{"c": 1}\n', u'[1, 2]\n', u'{"a": \n', u'{"a": {}}\n']:
+        try:
+            _read(data)
+        except BadExcelData as e:
+            assert_equal(e.row, 1)
+        else:
+            assert 0, data
+
+
+def test_read_ndjson_max_bytes():
+    data = b'{"a": 1}\n' * 10
+    sheet, res_id, column_names, rows = next(read_ndjson(
+        BytesIO(data), 'res-1', ['a', 'b'], max_bytes=len(data)))
+    assert_equal(len(list(rows)), 10)
+
+    sheet, res_id, column_names, rows = next(read_ndjson(
+        BytesIO(data + b'{"a": "' + b'x' * 1000 + b'"}'), 'res-1', ['a', 'b'],
+        max_bytes=len(data) + 10))
+    assert_raises(BadExcelData, list, rows)
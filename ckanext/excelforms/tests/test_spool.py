@@ -0,0 +1,62 @@
+# -*- coding: UTF-8 -*-
+import os
+import hashlib
+import tempfile
+from io import BytesIO
+
+from werkzeug.datastructures import FileStorage
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.spool import spooled_upload, file_sha256
+
+DATA = b'0123456789' * 1000
+
+
+def test_file_sha256_rewinds():
+    f = BytesIO(DATA)
+    f.read(10)
+    assert_equal(file_sha256(f), hashlib.sha256(DATA).hexdigest())
+    assert_equal(f.tell(), 0)
+
+
+def test_spooled_upload():
+    with spooled_upload(BytesIO(DATA)) as (f, sha256):
+        assert os.path.isfile(f.name)
+        assert_equal(f.read(), DATA)
+        assert_equal(sha256, hashlib.sha256(DATA).hexdigest())
+    assert not os.path.exists(f.name)
+
+
+def test_spooled_form_upload():
+    # werkzeug keeps form uploads in a SpooledTemporaryFile, which has
+    # no seekable() before Python 3.11
+    stream = tempfile.SpooledTemporaryFile(max_size=100)
+    stream.write(DATA)
+    stream.seek(0)
+    upload = FileStorage(stream, filename='data.csv', name='xls_update')
+    with spooled_upload(upload, max_bytes=len(DATA)) as (f, sha256):
+        assert os.path.isfile(f.name)
+        assert_equal(f.read(), DATA)
+        assert_equal(sha256, hashlib.sha256(DATA).hexdigest())
+
+
+def test_spooled_upload_too_large():
+    with assert_raises(BadExcelData):
+        with spooled_upload(BytesIO(DATA), max_bytes=len(DATA) - 1):
+            pass
+
+
+def test_file_on_disk_used_in_place():
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(DATA)
+        with open(path, 'rb') as upload:
+            with spooled_upload(upload, on_disk=True) as (f, sha256):
+                assert f is upload
+                assert_equal(sha256, hashlib.sha256(DATA).hexdigest())
+        assert os.path.exists(path)
+    finally:
+        os.remove(path)
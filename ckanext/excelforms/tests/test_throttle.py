@@ -0,0 +1,76 @@
+import time
+import threading
+from io import BytesIO
+from unittest import mock
+
+import flask
+from nose.tools import assert_equal
+
+from ckan.plugins.toolkit import config, g
+
+from ckanext.excelforms import blueprint, throttle
+from ckanext.excelforms.throttle import ConcurrencyLimit
+
+
+def test_limit_per_user():
+    limit = ConcurrencyLimit(0, 1)
+    assert limit.acquire('joe', 0)
+    assert not limit.acquire('joe', 0)
+    assert limit.acquire('sam', 0)
+    limit.release('joe')
+    assert limit.acquire('joe', 0)
+    assert_equal(limit.stats(), {
+        'active': 2, 'waiting': 0, 'users': 2, 'rejected': 1})
+
+
+def test_limit_per_process():
+    limit = ConcurrencyLimit(2, 0)
+    assert limit.acquire('joe', 0)
+    assert limit.acquire('joe', 0)
+    assert not limit.acquire('sam', 0.01)
+
+
+def test_waiting_request_gets_released_slot():
+    limit = ConcurrencyLimit(1, 0)
+    assert limit.acquire('joe', 0)
+    acquired = []
+    waiter = threading.Thread(
+        target=lambda: acquired.append(limit.acquire('sam', 5)))
+    waiter.start()
+    while not limit.stats()['waiting']:
+        time.sleep(0.001)
+    limit.release('joe')
+    waiter.join()
+    assert_equal(acquired, [True])
+    assert_equal(limit.stats()['active'], 1)
+
+
+class _SlowUpload(BytesIO):
+    """
+    Request body recording the active request count on every read
+    """
+    def __init__(self, data, active):
+        BytesIO.__init__(self, data)
+        self.active = active
+
+    def read(self, size=-1):
+        self.active.append(('read', throttle._get_limit().stats()['active']))
+        return BytesIO.read(self, size)
+
+
+def test_slot_not_held_while_spooling():
+    active = []
+
+    def load(*args):
+        active.append(('load', throttle._get_limit().stats()['active']))
+        return {}
+
+    with flask.Flask(__name__).test_request_context(), \
+            mock.patch.dict(config, {
+                'ckanext.excelforms.max_concurrent_requests': '1'}), \
+            mock.patch.object(blueprint, '_load_upload_file', load):
+        g.user = 'joe'
+        blueprint._process_upload_file(
+            None, 'res-1', _SlowUpload(b'{"a": 1}\n', active), [], False,
+            content_type='application/x-ndjson', stream=True)
+    assert_equal(active, [('read', 0), ('read', 0), ('load', 1)])
@@ -0,0 +1,157 @@
+# -*- coding: UTF-8 -*-
+"""
+Upload throughput regression tests: templates from excel_template
+filled with synthetic rows are loaded through the upload pipeline with
+a stub LocalCKAN, checking the records produced, rows per second and
+peak memory.
+
+The rows per second and peak memory benchmarks depend on the machine
+and are skipped unless EXCELFORMS_BENCHMARK is set.
+"""
+import os
+import time
+import tracemalloc
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock, SkipTest
+
+from nose.tools import assert_equal
+
+from ckanext.excelforms import write_excel
+from ckanext.excelforms.blueprint import _process_upload_file
+from ckanext.excelforms.write_excel import (
+    excel_template, DATA_FIRST_ROW, DATA_FIRST_COL_NUM)
+
+RESOURCE_ID = 'res-throughput'
+NUM_ROWS = 2000
+
+# conservative limits that fail only on real regressions, when
+# benchmarks are enabled
+MIN_ROWS_PER_SECOND = 1500
+MAX_PEAK_MEMORY_PER_ROW = 4 * 1024
+
+DD = [
+    {'id': '_id', 'type': 'int'},
+    {'id': 'name', 'type': 'text', 'info': {}},
+    {'id': 'count', 'type': 'int', 'info': {}},
+    {'id': 'amount', 'type': 'numeric', 'info': {}},
+    {'id': 'price', 'type': 'money', 'info': {}},
+    {'id': 'day', 'type': 'date', 'info': {}},
+    {'id': 'status', 'type': 'text', 'info': {
+        'excelforms_choices': u'A: Active\nI: Inactive'}},
+    {'id': 'tags', 'type': '_text', 'info': {}},
+    {'id': 'notes', 'type': 'text', 'info': {}},
+]
+
+
+def _synthetic_row(n):
+    return [
+        u'Name {0}'.format(n),
+        n,
+        n * 1.5,
+        u'{0}.25'.format(n),
+        u'2020-01-{0:02d}'.format(n % 28 + 1),
+        u'A' if n % 2 else u'I',
+        u'x,y',
+        u'Notes for row {0} é'.format(n),
+    ]
+
+
+# template helpers normally provided by CKAN and this plugin
+HELPERS = SimpleNamespace(
+    get_translated=lambda d, key: d.get(key),
+    url_for=lambda *args, **kwargs: u'/dataset',
+    lang=lambda: u'en',
+    excelforms_language_text=lambda f, field, lang=None: f.get(field, u''))
+
+_workbooks = {}
+
+
+def template_workbook(resource_id, dd, num_rows):
+    """
+    Return a BytesIO xlsx upload of the excel_template for dd with
+    num_rows rows of data entered on its form sheet
+    """
+    key = (resource_id, num_rows)
+    if key not in _workbooks:
+        with mock.patch.object(write_excel, 'h', HELPERS):
+            book = excel_template({
+                'id': resource_id,
+                'package_id': 'pkg-throughput',
+                'name': u'Throughput',
+                'excelforms_data_num_rows': num_rows,
+                }, dd)
+        sheet = book.worksheets[0]
+        for n in range(num_rows):
+            for col_num, value in enumerate(
+                    _synthetic_row(n), DATA_FIRST_COL_NUM):
+                sheet.cell(row=DATA_FIRST_ROW + n, column=col_num).value = value
+        blob = BytesIO()
+        book.save(blob)
+        _workbooks[key] = blob.getvalue()
+    return BytesIO(_workbooks[key])
+
+
+def _benchmark():
+    if not os.environ.get('EXCELFORMS_BENCHMARK'):
+        raise SkipTest('set EXCELFORMS_BENCHMARK to run benchmarks')
+
+
+class _StubAction(object):
+    def __init__(self):
+        self.upserts = []
+
+    def datastore_upsert(self, **kwargs):
+        self.upserts.append(kwargs)
+        return {}
+
+
+class _StubLocalCKAN(object):
+    username = 'throughput'
+
+    def __init__(self):
+        self.action = _StubAction()
+
+
+def test_upload_records():
+    upload = template_workbook(RESOURCE_ID, DD, NUM_ROWS)
+    lc = _StubLocalCKAN()
+    result = _process_upload_file(lc, RESOURCE_ID, upload, DD, False)
+
+    assert_equal(result['records'], NUM_ROWS)
+    assert_equal(len(lc.action.upserts), 1)
+    records = lc.action.upserts[0]['records']
+    assert_equal(len(records), NUM_ROWS)
+    assert_equal(records[3], {
+        'name': u'Name 3',
+        'count': u'3',
+        'amount': u'4.5',
+        'price': u'3.25',
+        'day': u'2020-01-04',
+        'status': u'A',
+        'tags': [u'x', u'y'],
+        'notes': u'Notes for row 3 é',
+        })
+
+
+def test_upload_rows_per_second():
+    _benchmark()
+    upload = template_workbook(RESOURCE_ID, DD, NUM_ROWS)
+    start = time.time()
+    _process_upload_file(_StubLocalCKAN(), RESOURCE_ID, upload, DD, False)
+    rows_per_second = NUM_ROWS / (time.time() - start)
+    assert rows_per_second > MIN_ROWS_PER_SECOND, (
+        '{0:.0f} rows/s'.format(rows_per_second))
+
+
+def test_upload_peak_memory():
+    _benchmark()
+    upload = template_workbook(RESOURCE_ID, DD, NUM_ROWS)
+    tracemalloc.start()
+    try:
+        _process_upload_file(_StubLocalCKAN(), RESOURCE_ID, upload, DD, False)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < MAX_PEAK_MEMORY_PER_ROW * NUM_ROWS, (
+        '{0} bytes peak'.format(peak))
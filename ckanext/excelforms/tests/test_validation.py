@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+from nose.tools import assert_equal
+
+from ckanext.excelforms.formula import compile_formula
+from ckanext.excelforms.validation import get_validators
+
+DD = [
+    {'id': 'count', 'type': 'int'},
+    {'id': 'amount', 'type': 'money'},
+    {'id': 'ratio', 'type': 'numeric'},
+    {'id': 'day', 'type': 'date'},
+    {'id': 'code', 'type': 'text', 'info': {
+        'excelforms_error_formula':
+            'OR({default_formula},LEN({cell})<>3,{count}>10)'}},
+    {'id': 'other', 'type': 'text', 'info': {
+        'excelforms_error_formula': 'COUNTIF(A1:A3,{cell})>0'}},
+]
+
+
+def _errors(record):
+    base = {
+        'count': u'1', 'amount': u'2.50', 'ratio': u'0.5',
+        'day': u'2020-11-15', 'code': u'ABC', 'other': u'x'}
+    base.update(record)
+    return [
+        field_id for field_id, check in get_validators(DD)
+        if check(base)]
+
+
+def test_valid_record():
+    assert_equal(_errors({}), [])
+    assert_equal(
+        _errors({'count': None, 'amount': u'', 'day': None, 'code': u''}),
+        [])
+
+
+def test_type_rules():
+    assert_equal(_errors({'count': u'4.5'}), ['count'])
+    assert_equal(_errors({'amount': u'2.555'}), ['amount'])
+    assert_equal(_errors({'ratio': u'lots'}), ['ratio'])
+    assert_equal(_errors({'day': u'2020-02-30'}), ['day'])
+
+
+def test_error_formula():
+    assert_equal(_errors({'code': u'ABCD'}), ['code'])
+    assert_equal(_errors({'count': u'11'}), ['code'])
+    # unsupported formulas are left to Excel and the datastore
+    assert_equal([f for f, c in get_validators(DD)].count('other'), 0)
+
+
+def test_formula_functions():
+    def ev(fmla, **refs):
+        return compile_formula(fmla, set(refs))(refs)
+    assert_equal(ev('TRIM(LEFT({cell},FIND(":",{cell}&":")-1))',
+        cell=u' AB : x'), u'AB')
+    assert_equal(ev('IFERROR(VALUE({cell}),-1)', cell=u'abc'), -1)
+    assert_equal(ev('"a"&1.50&TRUE'), u'a1.5TRUE')
+    assert_equal(ev('AND(1<2,"b">"A",NOT(FALSE))'), True)
+
+
+def test_non_iso_dates():
+    for day in (u'2020/01/15', u'2020-1-5', u'20200115', u'01/15/2020',
+            u'Jan 15, 2020', u'15 January 2020', u'2020-01-15 10:30'):
+        assert_equal(_errors({'day': day}), [], day)
+    for day in (u'2020/02/30', u'15/01/2020', u'soon'):
+        assert_equal(_errors({'day': day}), ['day'], day)
+
+
+def test_cell_is_numeric_for_number_fields():
+    dd = [
+        {'id': 'count', 'type': 'int', 'info': {
+            'excelforms_error_formula':
+                'OR({default_formula},{cell}>100)'}},
+        {'id': 'ratio', 'type': 'numeric', 'info': {
+            'excelforms_error_formula': 'NOT(ISNUMBER({cell}))'}},
+        ]
+
+    def errors(record):
+        return [f for f, check in get_validators(dd) if check(record)]
+
+    assert_equal(errors({'count': u'50', 'ratio': u'1.5'}), [])
+    assert_equal(errors({'count': u'150', 'ratio': u'x'}), ['count', 'ratio'])
+    assert_equal(errors({'count': u'4.5', 'ratio': u'1'}), ['count'])
+
+
+def test_values_beyond_decimal_precision():
+    assert_equal(_errors({'amount': u'1e30'}), [])
+    assert_equal(_errors({'amount': u'2.500'}), [])
+    assert_equal(_errors({'amount': u'1e-30'}), ['amount'])
+    assert_equal(_errors({'amount': u'1' * 30 + u'.001'}), ['amount'])
+
+    dd = [{'id': 'ratio', 'type': 'numeric', 'info': {
+        'excelforms_error_formula': 'ROUND({cell},2)<>{cell}'}}]
+    check = get_validators(dd)[0][1]
+    assert_equal(check({'ratio': u'1e40'}), None)
+    assert_equal(check({'ratio': u'1.5'}), None)
+    assert check({'ratio': u'1.555'})
@@ -0,0 +1,46 @@
+# -*- coding: UTF-8 -*-
+import os
+import time
+import multiprocessing
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.excelforms.workers import (
+    WorkerPool, WorkerCrashed, WorkerTimeout)
+
+
+def _pid():
+    return os.getpid()
+
+
+def _crash():
+    os._exit(1)
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+
+
+def test_pool_replaced_after_crash():
+    pool = WorkerPool(1)
+    try:
+        first = pool.run(10, _pid)
+        assert_raises(WorkerCrashed, pool.run, 10, _crash)
+        assert pool.run(10, _pid) not in (first, os.getpid())
+    finally:
+        pool.shutdown()
+
+
+def test_pool_replaced_after_timeout():
+    pool = WorkerPool(2)
+    try:
+        for n in range(3):
+            assert_raises(WorkerTimeout, pool.run, 0.5, _sleep, 30)
+            # timed out workers are stopped, not left running
+            assert len(multiprocessing.active_children()) <= 2
+        start = time.time()
+        assert_equal(pool.run(10, _sleep, 0), None)
+        assert time.time() - start < 10
+        assert len(multiprocessing.active_children()) <= 2
+    finally:
+        pool.shutdown()
@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+from types import SimpleNamespace
+from unittest import mock
+
+import openpyxl
+from nose.tools import assert_equal
+
+from ckanext.excelforms import write_excel
+from ckanext.excelforms.write_excel import (
+    _add_choice_validation, _data_style, _differential_style, _style_object,
+    apply_style, wrap_text_to_width, excel_dataset_template,
+    DEFAULT_ERROR_STYLE)
+
+# template helpers normally provided by CKAN and this plugin
+HELPERS = SimpleNamespace(
+    get_translated=lambda d, key: d.get(key),
+    url_for=lambda *args, **kwargs: u'/dataset',
+    lang=lambda: u'en',
+    excelforms_language_text=lambda f, field, lang=None: f.get(field, u''))
+
+
+def test_add_choice_validation_merges_identical():
+    book = openpyxl.Workbook()
+    sheet = book.active
+    validations = {}
+    _add_choice_validation(
+        sheet, validations, 'reference!$C$4:$C$6', u'A, B', 'C6:C10')
+    _add_choice_validation(
+        sheet, validations, 'reference!$C$4:$C$6', u'A, B', 'E6:E10')
+    _add_choice_validation(
+        sheet, validations, 'reference!$C$8:$C$9', u'X, Y', 'F6:F10')
+    dv = sheet.data_validations.dataValidation
+    assert_equal(len(dv), 2)
+    assert_equal(str(dv[0].sqref), 'C6:C10 E6:E10')
+
+
+def test_data_style_shared_by_format():
+    book = openpyxl.Workbook()
+    alignment = openpyxl.styles.Alignment(wrap_text=True)
+    a = _data_style(book, '@', alignment)
+    b = _data_style(book, '0.00', alignment)
+    assert_equal(_data_style(book, '@', alignment), a)
+    assert a != b
+
+
+def test_wrap_text_to_width():
+    text = u'short line\n' + u'word ' * 40
+    wrapped = wrap_text_to_width(text, 50)
+    assert_equal(wrapped.split(u'\n')[0], u'short line')
+    assert all(len(line) <= 44 for line in wrapped.split(u'\n'))
+    assert wrap_text_to_width(text, 50) is wrapped
+
+
+def test_style_objects_shared():
+    font = _style_object(openpyxl.styles.Font, DEFAULT_ERROR_STYLE['Font'])
+    assert font is _style_object(
+        openpyxl.styles.Font, dict(DEFAULT_ERROR_STYLE['Font']))
+    assert (_differential_style(DEFAULT_ERROR_STYLE)
+        is _differential_style(dict(DEFAULT_ERROR_STYLE)))
+
+    a = openpyxl.Workbook().active
+    b = openpyxl.Workbook().active
+    apply_style(a.row_dimensions[1], DEFAULT_ERROR_STYLE)
+    apply_style(b.row_dimensions[1], DEFAULT_ERROR_STYLE)
+    assert_equal(a.row_dimensions[1].font, font)
+    assert_equal(b.row_dimensions[1].font, font)
+
+
+def test_dataset_template_sheet_titles():
+    dd = [{'id': 'a', 'type': 'text', 'info': {}}]
+    with mock.patch.object(write_excel, 'h', HELPERS):
+        book = excel_dataset_template(
+            {'name': 'pkg', 'title': u'Package'}, [
+                ({'id': 'res-1', 'package_id': 'pkg', 'name': u'Sites'}, dd),
+                ({'id': 'res-2', 'package_id': 'pkg'}, dd),
+                ({'id': 'res-3', 'package_id': 'pkg', 'name': u'Visits',
+                    'excelforms_sheet_title': u'Visits [2020]'}, dd),
+                ])
+    assert_equal(
+        book.sheetnames[:4], [u'Sites', u'res2', u'Visits2020', u'reference'])
+
+
+def test_template_shares_validation_for_same_choices():
+    choices = u'A: Active\nI: Inactive'
+    dd = [
+        {'id': 'a', 'type': 'text', 'info': {'excelforms_choices': choices}},
+        {'id': 'b', 'type': 'text', 'info': {'excelforms_choices': u'X\nY'}},
+        {'id': 'c', 'type': 'text', 'info': {'excelforms_choices': choices}},
+        ]
+    with mock.patch.object(write_excel, 'h', HELPERS):
+        book = write_excel.excel_template(
+            {'id': 'res-1', 'package_id': 'pkg', 'name': u'Sites',
+                'excelforms_data_num_rows': 10}, dd)
+    dv = book.worksheets[0].data_validations.dataValidation
+    assert_equal(len(dv), 2)
+    assert_equal(str(dv[0].sqref), 'C6:C15 E6:E15')
+    assert_equal(dv[0].formula1, 'reference!$C$8:$C$9')
+    reference = book['reference']
+    assert_equal(
+        [reference.cell(row=n, column=3).value for n in (8, 9)],
+        [u'A', u'I'])
@@ -0,0 +1,164 @@
+"""
+Limits on concurrent uploads and template builds in each web server
+process, overall and per user, so bursts of large files wait briefly
+or are turned away instead of exhausting memory
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from logging import getLogger, DEBUG, INFO
+
+from ckan.plugins.toolkit import _, config, g, request
+
+from ckanext.excelforms.errors import BadExcelData
+
+log = getLogger(__name__)
+
+DEFAULT_CONCURRENCY_WAIT = 10
+DEFAULT_RETRY_AFTER = 30
+
+_limit = None
+_limit_lock = threading.Lock()
+
+
+class Busy(BadExcelData):
+    """
+    Raised when no request slot became free within the configured wait
+    """
+    def __init__(self, retry_after):
+        BadExcelData.__init__(self, _(
+            "The server is busy processing other files. Please try "
+            "again in {0} seconds.").format(retry_after))
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimit(object):
+    """
+    Counting semaphore for requests in this process with a second,
+    smaller count per user. 0 disables either limit. The numbers of
+    active, queued and rejected requests are kept for logging.
+    """
+    def __init__(self, max_requests, max_per_user):
+        self.max_requests = max_requests
+        self.max_per_user = max_per_user
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._users = {}
+        self._cond = threading.Condition()
+
+    def _available(self, user):
+        return (
+            (not self.max_requests or self.active < self.max_requests) and
+            (not self.max_per_user
+                or self._users.get(user, 0) < self.max_per_user))
+
+    def acquire(self, user, timeout):
+        """
+        Return True once a slot is held for user, or False if none
+        became free within timeout seconds
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while not self._available(user):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self._users[user] = self._users.get(user, 0) + 1
+        return True
+
+    def release(self, user):
+        with self._cond:
+            self.active -= 1
+            self._users[user] -= 1
+            if not self._users[user]:
+                del self._users[user]
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'active': self.active,
+                'waiting': self.waiting,
+                'users': len(self._users),
+                'rejected': self.rejected,
+                }
+
+
+def _get_limit():
+    global _limit
+    max_requests = int(config.get(
+        'ckanext.excelforms.max_concurrent_requests', 0))
+    max_per_user = int(config.get(
+        'ckanext.excelforms.max_concurrent_requests_per_user', 0))
+    if not (max_requests or max_per_user):
+        return None
+    with _limit_lock:
+        if _limit is None or (_limit.max_requests, _limit.max_per_user) != (
+                max_requests, max_per_user):
+            _limit = ConcurrencyLimit(max_requests, max_per_user)
+    return _limit
+
+
+def concurrency_limited():
+    """
+    Return True when concurrent requests are limited
+    """
+    return _get_limit() is not None
+
+
+@contextmanager
+def request_slot():
+    """
+    Context manager holding one of the concurrent request slots for the
+    current user (or client address for anonymous users), waiting up
+    to ckanext.excelforms.concurrency_wait seconds for one to be free
+
+    raises Busy when no slot became free.
+    """
+    limit = _get_limit()
+    if limit is None:
+        yield
+        return
+
+    user = g.user or request.remote_addr
+    start = time.time()
+    if not limit.acquire(user, float(config.get(
+            'ckanext.excelforms.concurrency_wait',
+            DEFAULT_CONCURRENCY_WAIT))):
+        log.warning(
+            'excelforms request by %s rejected after %.3fs: %r',
+            user, time.time() - start, limit.stats())
+        raise Busy(int(config.get(
+            'ckanext.excelforms.concurrency_retry_after',
+            DEFAULT_RETRY_AFTER)))
+
+    waited = time.time() - start
+    log.log(
+        INFO if waited >= 0.1 else DEBUG,
+        'excelforms request by %s waited %.3fs: %r',
+        user, waited, limit.stats())
+    try:
+        yield
+    finally:
+        limit.release(user)
+
+
+def limited(fn):
+    """
+    Decorator for functions that run while holding a request slot
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with request_slot():
+            return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,207 @@
+"""
+Server-side validation of uploaded records mirroring the error formulas
+the template puts on its e1 sheet, so bad rows are rejected before
+anything is sent to the datastore.
+"""
+
+import re
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from logging import getLogger
+
+from six import text_type
+
+from ckan.plugins.toolkit import _
+
+from ckanext.excelforms.cache import LRUCache, fingerprint
+from ckanext.excelforms.choices import get_choice_fields, invalid_choices
+from ckanext.excelforms.formula import (
+    compile_formula, UnsupportedFormula, ExcelError)
+
+log = getLogger(__name__)
+
+VALIDATORS_CACHE_SIZE = 100
+NUMERIC_TYPES = ('int', 'bigint', 'numeric', 'money', 'year', 'month')
+# year-month-day with an optional time, as written by canonicalize
+DATE_RE = re.compile(
+    r'(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})(?:$|[T ])')
+# other date layouts PostgreSQL accepts for date columns (DateStyle
+# ISO, MDY), after commas are removed and spaces collapsed
+DATE_FORMATS = (
+    '%Y%m%d', '%m/%d/%Y', '%m-%d-%Y', '%d %b %Y', '%d %B %Y',
+    '%b %d %Y', '%B %d %Y')
+
+_cache = LRUCache(VALIDATORS_CACHE_SIZE)
+
+
+def get_validators(dd):
+    """
+    Return [(field_id, check), ...] for data dictionary dd where
+    check(record) returns an error message for a canonicalized record
+    or None.
+
+    Checks are compiled once per data dictionary fingerprint.
+    """
+    return _cache.get_or_create(fingerprint(dd), lambda: _validators(dd))
+
+
+def _validators(dd):
+    choice_fields = get_choice_fields(dd)
+    fields = [f for f in dd if f['id'] != '_id']
+    types = dict((f['id'], f['type']) for f in fields)
+    names = set(types) | set(['cell', 'default_formula'])
+
+    validators = []
+    for f in fields:
+        info = f.get('info') or {}
+        choice_field = choice_fields.get(f['id'])
+        default_check = _default_check(f['type'], choice_field)
+        user_fmla = info.get('excelforms_error_formula')
+        filter_fmla = info.get('excelforms_error_cell_filter_formula')
+
+        try:
+            user_check = compile_formula(user_fmla, names) if user_fmla else None
+            cell_filter = (
+                compile_formula(filter_fmla, names) if filter_fmla else None)
+        except UnsupportedFormula as e:
+            # leave this rule to Excel and the datastore
+            log.debug('unsupported formula for %s: %s', f['id'], e)
+            continue
+
+        if not (default_check or user_check):
+            continue
+
+        validators.append((f['id'], _field_check(
+            f['id'], types, default_check, user_check, cell_filter,
+            bool(choice_field))))
+    return validators
+
+
+def _field_check(field_id, types, default_check, user_check, cell_filter,
+        choice):
+    def check(record):
+        value = record.get(field_id)
+        if _is_blank(value):
+            return
+        cell = value
+        if user_check or cell_filter:
+            refs = _formula_refs(record, types)
+            cell = refs[field_id]
+            if cell_filter:
+                try:
+                    cell = cell_filter(refs)
+                except ExcelError:
+                    return
+            refs['cell'] = cell
+
+        if user_check:
+            refs['default_formula'] = lambda: bool(
+                default_check and default_check(cell))
+            try:
+                error = _truthy(user_check(refs))
+            except ExcelError:
+                return
+        else:
+            error = default_check(cell)
+
+        if error:
+            if choice:
+                return _(u'Invalid choice for {0}: {1}').format(
+                    field_id, _display(value))
+            return _(u'Invalid value for {0}: {1}').format(
+                field_id, _display(value))
+    return check
+
+
+def _default_check(dtype, choice_field):
+    """
+    Return function(value) that is True when value is in error for
+    the same type and choice rules as the default e1 sheet formulas
+    """
+    if dtype == 'date':
+        return lambda v: not _is_date(v)
+    if dtype == 'int':
+        return lambda v: not _is_whole_number(v)
+    if dtype == 'numeric':
+        return lambda v: _decimal(v) is None
+    if dtype == 'money':
+        return lambda v: not _is_money(v)
+    if choice_field:
+        return lambda v: bool(invalid_choices(choice_field, v))
+
+
+def _formula_refs(record, types):
+    refs = {}
+    for field_id, value in record.items():
+        if types.get(field_id) in NUMERIC_TYPES:
+            number = _decimal(value)
+            if number is not None:
+                value = number
+        refs[field_id] = value
+    return refs
+
+
+def _is_blank(value):
+    return value is None or value == u'' or value == []
+
+
+def _truthy(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, Decimal):
+        return value != 0
+    return bool(value)
+
+
+def _decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    try:
+        return Decimal(value)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+
+
+def _is_whole_number(value):
+    d = _decimal(value)
+    return d is not None and d.is_finite() and d == d.to_integral_value()
+
+
+def _is_money(value):
+    # compare digits instead of quantizing, which fails for values
+    # with more digits than the decimal context precision
+    d = _decimal(value)
+    if d is None or not d.is_finite():
+        return False
+    sign, digits, exponent = d.as_tuple()
+    while exponent < -2 and digits and not digits[-1]:
+        digits = digits[:-1]
+        exponent += 1
+    return exponent >= -2 or not any(digits)
+
+
+def _is_date(value):
+    if not isinstance(value, text_type):
+        return False
+    value = value.strip()
+    m = DATE_RE.match(value)
+    if m:
+        try:
+            date(*(int(n) for n in m.groups()))
+        except ValueError:
+            return False
+        return True
+    value = u' '.join(value.replace(u',', u' ').split())
+    for fmt in DATE_FORMATS:
+        try:
+            datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return True
+    return False
+
+
+def _display(value):
+    if isinstance(value, list):
+        return u', '.join(value)
+    return value
@@ -0,0 +1,180 @@
+"""
+Bounded pool of worker processes for CPU-heavy template builds and
+upload parsing, so they don't block the web worker serving requests
+"""
+
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from ckan.plugins.toolkit import config, h, request
+
+from ckanext.excelforms.errors import ExcelFormsException
+from ckanext.excelforms.profiling import profiling
+
+DEFAULT_WORKER_PROCESSES = 0
+DEFAULT_WORKER_TIMEOUT = 300
+# seconds to wait for a terminated worker process to exit
+WORKER_JOIN_TIMEOUT = 5
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# flask app inherited by forked worker processes
+_app = None
+
+
+class WorkerUnavailable(ExcelFormsException):
+    pass
+
+
+class WorkerTimeout(WorkerUnavailable):
+    pass
+
+
+class WorkerCrashed(WorkerUnavailable):
+    pass
+
+
+class WorkerPool(object):
+    """
+    ProcessPoolExecutor that is replaced with a new one when a worker
+    process dies (e.g. killed for using too much memory), which leaves
+    the executor unusable, or when a call times out while running.
+    After a timeout the old executor's processes are terminated so
+    there are never more than max_workers processes; other calls
+    running on them fail with WorkerCrashed.
+    """
+    def __init__(self, max_workers, initializer=None):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=self.initializer)
+            return self._executor
+
+    def _replace(self, executor, terminate=False):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        if terminate:
+            _terminate_workers(executor)
+        executor.shutdown(wait=False)
+
+    def run(self, timeout, fn, *args):
+        """
+        Return fn(*args) run in a worker process
+
+        raises WorkerTimeout when the result isn't ready within timeout
+        seconds, including time spent waiting for a free worker, or
+        WorkerCrashed when the worker process died.
+        """
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            # broken by an earlier call, retry once with a new executor
+            self._replace(executor)
+            executor = self._get_executor()
+            future = executor.submit(fn, *args)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            if not future.cancel():
+                self._replace(executor, terminate=True)
+            raise WorkerTimeout()
+        except BrokenProcessPool:
+            self._replace(executor)
+            raise WorkerCrashed()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def _terminate_workers(executor):
+    """
+    Stop the worker processes of executor, including any running calls
+    """
+    terminate_workers = getattr(executor, 'terminate_workers', None)
+    if terminate_workers is not None:
+        # Python 3.14+
+        terminate_workers()
+        return
+    # earlier versions only keep the processes in a private attribute
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(WORKER_JOIN_TIMEOUT)
+
+
+def run_heavy(fn, *args):
+    """
+    Return fn(*args) run in the worker pool when
+    ckanext.excelforms.worker_processes is set, or in this process
+    otherwise. fn and args must be picklable.
+
+    fn is called within a request context for the current language so
+    that translations and helpers work as they do in the web request.
+
+    raises WorkerTimeout when the result isn't ready within
+    ckanext.excelforms.worker_timeout seconds, including time spent
+    waiting for a free worker, or WorkerCrashed when the worker
+    process died.
+    """
+    pool = _get_pool()
+    if pool is None or profiling():
+        return fn(*args)
+    return pool.run(
+        int(config.get(
+            'ckanext.excelforms.worker_timeout', DEFAULT_WORKER_TIMEOUT)),
+        _call_in_request, h.lang(), request.url_root, fn, args)
+
+
+def workers_enabled():
+    """
+    Return True when run_heavy uses worker processes
+    """
+    return bool(int(config.get(
+        'ckanext.excelforms.worker_processes', DEFAULT_WORKER_PROCESSES)))
+
+
+def _get_pool():
+    global _pool, _pool_pid, _app
+    if not workers_enabled():
+        return None
+    with _pool_lock:
+        # web servers fork after import: one pool per web worker process
+        if _pool is None or _pool_pid != os.getpid():
+            from flask import current_app
+            _app = current_app._get_current_object()
+            _pool = WorkerPool(
+                int(config.get('ckanext.excelforms.worker_processes')),
+                _warm_worker)
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def _warm_worker():
+    import openpyxl  # noqa
+    import ckanext.excelforms.write_excel  # noqa
+    import ckanext.excelforms.read_excel  # noqa
+
+
+def _call_in_request(lang, url_root, fn, args):
+    with _app.test_request_context(
+            base_url=url_root, environ_overrides={'CKAN_LANG': lang}):
+        return fn(*args)
@@ -5,13 +5,20 @@ Excel v3 template and data-dictionary generation code
 
 import re
 import textwrap
+import weakref
 import string
 
 import openpyxl
 from openpyxl.utils import get_column_letter
-from openpyxl.formatting.rule import FormulaRule
+from openpyxl.formatting.rule import Rule
 from openpyxl.styles import NamedStyle
+from openpyxl.styles.differential import DifferentialStyle
+from openpyxl.worksheet.datavalidation import DataValidation
 
+from six import text_type
+
+from .cache import LRUCache
+from .choices import get_choice_fields
 from .datatypes import datastore_type
 
 from ckan.plugins.toolkit import _, h, asbool
@@ -96,39 +103,75 @@ REF_PAPER_STYLE = {
 TYPE_HERE_STYLE = {
     'Font': {'bold': True, 'size': 16}}
 
+# descriptions and choice labels repeat across builds of the same
+# templates and in each language
+TEXT_CACHE_SIZE = 10000
+# lines textwrap would return unchanged when short enough
+PLAIN_LINE_RE = re.compile(r'^(?:\S(?:[^\t\n\x0b\x0c\r]*\S)?)?$')
+_wrapped_text = LRUCache(TEXT_CACHE_SIZE)
+# {book: {(xl_format, alignment): data style name}}
+_data_styles = weakref.WeakKeyDictionary()
+_text_widths = LRUCache(TEXT_CACHE_SIZE)
+
 
 def excel_template(resource, dd):
     """
     return an openpyxl.Workbook object containing the sheet and header fields
     for passed column definitions dd.
     """
+    return _excel_workbook(resource, [(resource, dd)])
+
+
+def excel_dataset_template(package, resources):
+    """
+    return an openpyxl.Workbook object with a form sheet for each of
+    resources, a list of (resource, dd) pairs from package, sharing
+    one reference sheet and one set of named styles.
+    """
+    title = dict(
+        package,
+        name=h.get_translated(package, 'title') or package['name'])
+    return _excel_workbook(title, resources, resource_titles=True)
 
+
+def _excel_workbook(title_resource, resources, resource_titles=False):
     book = openpyxl.Workbook()
-    form_sheet = book.active
     refs = []
 
-    _build_styles(book, dd)
-    cranges = _populate_excel_sheet(book, form_sheet, resource, dd, refs)
-    form_sheet.protection.enabled = True
-    form_sheet.protection.formatRows = False
-    form_sheet.protection.formatColumns = False
+    _build_styles(book, None)
+    forms = []
+    for resource_num, (resource, dd) in enumerate(resources, 1):
+        form_sheet = book.active if resource_num == 1 else book.create_sheet()
+        if resource_titles:
+            refs.append(('resource_title', [
+                h.get_translated(resource, 'name') or resource['id']]))
+        cranges = _populate_excel_sheet(
+            book, form_sheet, resource, dd, refs, resource_num)
+        form_sheet.protection.enabled = True
+        form_sheet.protection.formatRows = False
+        form_sheet.protection.formatColumns = False
+        forms.append((form_sheet.title, resource, dd, cranges))
 
     sheet = book.create_sheet()
-    _populate_reference_sheet(sheet, resource, dd, refs)
+    _populate_reference_sheet(sheet, title_resource, None, refs)
     sheet.title = 'reference'
     sheet.protection.enabled = True
 
-    sheet = book.create_sheet()
-    _populate_excel_e_sheet(sheet, dd, cranges)
-    sheet.title = 'e1'
-    sheet.protection.enabled = True
-    sheet.sheet_state = 'hidden'
-
-    sheet = book.create_sheet()
-    _populate_excel_r_sheet(sheet, resource, dd, form_sheet.title)
-    sheet.title = 'r1'
-    sheet.protection.enabled = True
-    sheet.sheet_state = 'hidden'
+    for resource_num, (form_title, resource, dd, cranges) in enumerate(
+            forms, 1):
+        sheet = book.create_sheet()
+        _populate_excel_e_sheet(sheet, dd, cranges, form_title)
+        sheet.title = 'e{0}'.format(resource_num)
+        sheet.protection.enabled = True
+        sheet.sheet_state = 'hidden'
+
+    for resource_num, (form_title, resource, dd, cranges) in enumerate(
+            forms, 1):
+        sheet = book.create_sheet()
+        _populate_excel_r_sheet(sheet, resource, dd, form_title)
+        sheet.title = 'r{0}'.format(resource_num)
+        sheet.protection.enabled = True
+        sheet.sheet_state = 'hidden'
     return book
 
 
@@ -176,14 +219,21 @@ def estimate_width_from_length(length):
         range2 * ESTIMATE_WIDTH_MULTIPLE_2)
 
 def estimate_width(text):
-    return max(estimate_width_from_length(len(s)) for s in text.split('\n'))
+    return _text_widths.get_or_create(text, lambda: max(
+        estimate_width_from_length(len(s)) for s in text.split('\n')))
 
 def wrap_text_to_width(text, width):
+    return _wrapped_text.get_or_create(
+        (text, width), lambda: _wrap_text_to_width(text, width))
+
+def _wrap_text_to_width(text, width):
     # assuming width > ESTIMATE_WIDTH_MULTIPLE_1_CHARS
     width -= ESTIMATE_WIDTH_MULTIPLE_1_CHARS * ESTIMATE_WIDTH_MULTIPLE_1
-    cwidth = width // ESTIMATE_WIDTH_MULTIPLE_2 + ESTIMATE_WIDTH_MULTIPLE_1_CHARS
+    cwidth = int(
+        width // ESTIMATE_WIDTH_MULTIPLE_2 + ESTIMATE_WIDTH_MULTIPLE_1_CHARS)
     return '\n'.join(
-        '\n'.join(textwrap.wrap(line, cwidth))
+        line if len(line) <= cwidth and PLAIN_LINE_RE.match(line)
+        else '\n'.join(textwrap.wrap(line, cwidth))
         for line in text.split('\n'))
 
 
@@ -215,6 +265,7 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, resource_num=1):
     sheet.title = re.sub(
         EXCEL_SHEET_NAME_INVALID_RE, '', str(
             resource.get('excelforms_sheet_title')
+            or resource.get('name') or resource['id']
         )
     ).strip()[:EXCEL_SHEET_NAME_MAX] or DEFAULT_SHEET_NAME
 
@@ -285,11 +336,12 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, resource_num=1):
 
     cheadings_dimensions = sheet.row_dimensions[CHEADINGS_ROW]
 
-    choice_fields = {}
-# FIXME: enable choices in data dictionary
-#    choice_fields = dict(
-#        (f['datastore_id'], f['choices'])
-#        for f in recombinant_choice_fields(chromo['resource_name']))
+    choice_fields = get_choice_fields(dd)
+    validations = {}
+    # {(choices, full_text): (choice_range, ref1, refN)} of the first
+    # field with each choice list, so fields with the same list share
+    # one validation
+    shared_choice_ranges = {}
 
     for col_num, field in template_cols_fields(dd):
         field_heading = h.excelforms_language_text(
@@ -360,15 +412,11 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, resource_num=1):
             rowN=DATA_FIRST_ROW + data_num_rows - 1)
 
         xl_format = datastore_type[field['type']].xl_format
-        alignment = openpyxl.styles.Alignment(wrap_text=True)
-        col_style = NamedStyle(
-            name='xlf_{0}{1}'.format(resource_num, col_letter),
-            number_format=xl_format,
-            alignment=alignment,
-            protection=openpyxl.styles.Protection(locked=False))
-        book.add_named_style(col_style)
+        alignment = _style_object(
+            openpyxl.styles.Alignment, {'wrap_text': True})
+        col_style = _data_style(book, xl_format, alignment)
         for (c,) in sheet[validation_range]:
-            c.style = col_style.name
+            c.style = col_style
         ex_cell = sheet.cell(row=EXAMPLE_ROW, column=col_num)
         ex_cell.number_format = xl_format
         ex_cell.alignment = alignment
@@ -377,28 +425,24 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, resource_num=1):
             sheet=sheet.title, col=col_letter, row=CHEADINGS_ROW))
 
         if field['id'] in choice_fields:
-            full_text_choices = (
-                field['datastore_type'] != '_text' and field.get(
-                'excel_full_text_choices', False))
+            choice_field = choice_fields[field['id']]
             ref1 = len(refs) + REF_FIRST_ROW
-            max_choice_width = _append_field_choices_rows(
-                refs,
-                choice_fields[field['datastore_id']],
-                full_text_choices)
+            max_choice_width = _append_field_choices_rows(refs, choice_field)
             refN = len(refs) + REF_FIRST_ROW - 2
 
-            if full_text_choices:
+            if choice_field.full_text:
                 if 'excel_column_width' not in field:
                     col.width = max(col.width, max_choice_width)
                 # expand example
-                for ck, cv in choice_fields[field['datastore_id']]:
-                    if ck == example:
+                for ck, cv in choice_field.choices:
+                    if example and ck == example.get(field['id']):
                         ex_cell.value = u"{0}: {1}".format(ck, cv)
                         break
 
             choice_range = 'reference!${col}${ref1}:${col}${refN}'.format(
                 col=REF_KEY_COL, ref1=ref1, refN=refN)
-            user_choice_range = field.get('excel_choice_range_formula')
+            user_choice_range = field['info'].get(
+                'excelforms_choice_range_formula')
             if user_choice_range:
                 choice_keys = set(
                     key for (_i, key, _i, _i) in string.Formatter().parse(user_choice_range)
@@ -406,33 +450,35 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, resource_num=1):
                 choice_values = {}
                 if choice_keys:
                     choice_values = {
-                        f['datastore_id']: "{col}{num}".format(
+                        f['id']: "{col}{num}".format(
                             col=get_column_letter(cn),
                             num=DATA_FIRST_ROW)
-                        for cn, f in template_cols_fields(chromo)
-                        if f['datastore_id'] in choice_keys}
+                        for cn, f in template_cols_fields(dd)
+                        if f['id'] in choice_keys}
                 user_choice_range = user_choice_range.format(
                     range=choice_range,
                     range_top=choice_range.split(':')[0],
                     **choice_values)
-            cranges[field['datastore_id']] = choice_range
-
-            choices = [c[0] for c in choice_fields[field['datastore_id']]]
-            if field['datastore_type'] != '_text':
-                v = openpyxl.worksheet.datavalidation.DataValidation(
-                    type="list",
-                    formula1=user_choice_range or choice_range,
-                    allow_blank=True)
-                v.errorTitle = u'Invalid choice'
-                valid_keys = u', '.join(unicode(c) for c in choices)
+            cranges[field['id']] = choice_range
+
+            if field['type'] != '_text':
+                if not user_choice_range:
+                    choice_range, ref1, refN = shared_choice_ranges.setdefault(
+                        (tuple(choice_field.choices), choice_field.full_text),
+                        (choice_range, ref1, refN))
+                valid_keys = choice_field.valid_keys
                 if len(valid_keys) < 40:
-                    v.error = (u'Please enter one of the valid keys: '
+                    error = (u'Please enter one of the valid keys: '
                         + valid_keys)
                 else:
-                    v.error = (u'Please enter one of the valid keys shown on '
+                    error = (u'Please enter one of the valid keys shown on '
                         'sheet "reference" rows {0}-{1}'.format(ref1, refN))
-                sheet.add_data_validation(v)
-                v.add(validation_range)
+                _add_choice_validation(
+                    sheet,
+                    validations,
+                    user_choice_range or choice_range,
+                    error,
+                    validation_range)
 
         sheet.cell(row=CHEADINGS_ROW, column=col_num).hyperlink = (
             '#reference!{colA}{row1}:{colZ}{rowN}'.format(
@@ -510,19 +556,11 @@ def _append_field_ref_rows(refs, field, link):
         field['type'],
     ]))
 
-def _append_field_choices_rows(refs, choices, full_text_choices):
+def _append_field_choices_rows(refs, choice_field):
     refs.append(('choice heading', [_('Values')]))
-    max_length = 0
-    for key, value in choices:
-        if full_text_choices:
-            choice = [u'{0}: {1}'.format(key, value)]
-        elif unicode(key) == value:
-            choice = [unicode(key)]
-        else:
-            choice = [unicode(key), value]
-        refs.append(('choice', choice))
-        max_length = max(max_length, len(choice[0]))  # used for full_text_choices
-    return estimate_width_from_length(max_length)
+    refs.extend(choice_field.ref_rows)
+    # used for full_text_choices
+    return estimate_width_from_length(choice_field.max_length)
 
 def _populate_reference_sheet(sheet, resource, dd, refs):
     field_count = 1
@@ -619,7 +657,7 @@ def _populate_reference_sheet(sheet, resource, dd, refs):
     sheet.column_dimensions[REF_VALUE_COL].width = REF_VALUE_WIDTH
 
 
-def _populate_excel_e_sheet(sheet, dd, cranges):
+def _populate_excel_e_sheet(sheet, dd, cranges, form_sheet_title):
     """
     Populate the "error" calculation excel worksheet
 
@@ -700,17 +738,18 @@ def _populate_excel_e_sheet(sheet, dd, cranges):
         fmla_keys = set(
             key for (_i, key, _i, _i) in string.Formatter().parse(fmla)
             if key != 'cell' and key != 'default_formula')
+        fmla_values = {}
         if fmla_keys:
             fmla_values = {
-                f['datastore_id']: "'{sheet}'!{col}{{num}}".format(
-                    sheet=chromo['resource_name'],
+                f['id']: "'{sheet}'!{col}{{num}}".format(
+                    sheet=form_sheet_title,
                     col=get_column_letter(cn))
-                for cn, f in template_cols_fields(chromo)
-                if f['datastore_id'] in fmla_keys}
+                for cn, f in template_cols_fields(dd)
+                if f['id'] in fmla_keys}
 
         col = get_column_letter(col_num)
         cell = "'{sheet}'!{col}{{num}}".format(
-            sheet=chromo['resource_name'],
+            sheet=form_sheet_title,
             col=col)
         fmla = '=NOT({cell}="")*(' + fmla + ')'
         for i in range(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
@@ -811,7 +850,7 @@ def _populate_excel_r_sheet(sheet, resource, dd, form_sheet_title):
     for i in range(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
         sheet.cell(row=i, column=RPAD_COL_NUM).value = (
             "=SUMPRODUCT(LEN('{sheet}'!{colA}{row}:{colZ}{row}))>0".format(
-                sheet=chromo['resource_name'],
+                sheet=form_sheet_title,
                 colA=DATA_FIRST_COL,
                 colZ=col,
                 row=i))
@@ -866,13 +905,39 @@ def apply_style(target, config):
     """
     pattern_fill = config.get('PatternFill')
     if pattern_fill:
-        target.fill = openpyxl.styles.PatternFill(**pattern_fill)
+        target.fill = _style_object(openpyxl.styles.PatternFill, pattern_fill)
     font = config.get('Font')
     if font:
-        target.font = openpyxl.styles.Font(**font)
+        target.font = _style_object(openpyxl.styles.Font, font)
     alignment = config.get('Alignment')
     if alignment:
-        target.alignment = openpyxl.styles.Alignment(**alignment)
+        target.alignment = _style_object(openpyxl.styles.Alignment, alignment)
+
+
+_style_objects = {}
+
+
+def _style_object(cls, config):
+    """
+    Return a shared cls(**config) style object (PatternFill, Font,
+    DifferentialStyle etc.), created once per distinct config in this
+    process. Style objects are copied into a workbook's style tables when
+    assigned, so they are safe to reuse for every row, cell, rule and
+    workbook as long as they are never modified.
+    """
+    key = (cls, _freeze(config))
+    style = _style_objects.get(key)
+    if style is None:
+        style = _style_objects.setdefault(key, cls(**config))
+    return style
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
 
 
 def org_title_lang_hack(title):
@@ -895,61 +960,113 @@ def template_cols_fields(dd):
         DATA_FIRST_COL_NUM
     )
 
+def _data_style(book, xl_format, alignment):
+    """
+    Return the name of the unlocked data entry style for xl_format,
+    adding it to book the first time so columns of the same type share
+    a single named style
+    """
+    styles = _data_styles.setdefault(book, {})
+    name = styles.get((xl_format, alignment))
+    if name is None:
+        name = styles[xl_format, alignment] = 'xlf_data_{0}'.format(
+            len(book.named_styles))
+        book.add_named_style(NamedStyle(
+            name=name,
+            number_format=xl_format,
+            alignment=alignment,
+            protection=_style_object(
+                openpyxl.styles.Protection, {'locked': False})))
+    return name
+
+
+def _add_choice_validation(sheet, validations, formula, error, sqref):
+    """
+    Add a list data validation for sqref to sheet, extending an
+    identical validation already on the sheet when there is one
+
+    validations - {(formula, error): DataValidation} for sheet,
+        modified in place from this function
+    """
+    v = validations.get((formula, error))
+    if v is None:
+        v = validations[formula, error] = DataValidation(
+            type="list",
+            formula1=formula,
+            allow_blank=True)
+        v.errorTitle = u'Invalid choice'
+        v.error = error
+        sheet.add_data_validation(v)
+    v.add(sqref)
+
+
+def _differential_style(config):
+    """
+    Return the shared conditional formatting style for a style config
+    with PatternFill and Font
+    """
+    return _style_object(DifferentialStyle, {
+        'fill': _style_object(
+            openpyxl.styles.PatternFill,
+            dict(config['PatternFill'],
+                bgColor=config['PatternFill']['fgColor'])),
+        'font': _style_object(openpyxl.styles.Font, config['Font'])})
+
+
 def _add_conditional_formatting(
         sheet, col_letter, resource_num, error_style, required_style,
         data_num_rows):
     '''
     Error and required cell hilighting based on e/r sheets
     '''
-    error_fill = openpyxl.styles.PatternFill(
-        bgColor=error_style['PatternFill']['fgColor'],
-        **error_style['PatternFill'])
-    error_font = openpyxl.styles.Font(**error_style['Font'])
-    required_fill = openpyxl.styles.PatternFill(
-        bgColor=required_style['PatternFill']['fgColor'],
-        **required_style['PatternFill'])
-    required_font = openpyxl.styles.Font(**required_style['Font'])
+    # one differential style for each kind of hilighting, shared by
+    # all the rules that use it
+    error_dxf = _differential_style(error_style)
+    required_dxf = _differential_style(required_style)
 
     sheet.conditional_formatting.add(
         '{col}{row1}:{col}{rowN}'.format(
             col=RSTATUS_COL,
             row1=DATA_FIRST_ROW,
             rowN=DATA_FIRST_ROW + data_num_rows - 1),
-        FormulaRule([
-            'AND(e{rnum}!{colA}{row1}=0,r{rnum}!{colA}{row1}>0)'.format(
-                rnum=resource_num,
-                colA=RSTATUS_COL,
-                row1=DATA_FIRST_ROW)],
-        stopIfTrue=True,
-        fill=required_fill,
-        font=required_font))
+        Rule(
+            type='expression',
+            formula=[
+                'AND(e{rnum}!{colA}{row1}=0,r{rnum}!{colA}{row1}>0)'.format(
+                    rnum=resource_num,
+                    colA=RSTATUS_COL,
+                    row1=DATA_FIRST_ROW)],
+            stopIfTrue=True,
+            dxf=required_dxf))
     sheet.conditional_formatting.add(
         '{colA}{row1}:{colZ}{rowN}'.format(
             colA=RSTATUS_COL,
             row1=CSTATUS_ROW,
             colZ=col_letter,
             rowN=DATA_FIRST_ROW + data_num_rows - 1),
-        FormulaRule([
-            'AND(ISNUMBER(e{rnum}!{colA}{row1}),'
-            'e{rnum}!{colA}{row1}>0)'.format(
-                rnum=resource_num,
-                colA=RSTATUS_COL,
-                row1=CSTATUS_ROW)],
-        stopIfTrue=True,
-        fill=error_fill,
-        font=error_font))
+        Rule(
+            type='expression',
+            formula=[
+                'AND(ISNUMBER(e{rnum}!{colA}{row1}),'
+                'e{rnum}!{colA}{row1}>0)'.format(
+                    rnum=resource_num,
+                    colA=RSTATUS_COL,
+                    row1=CSTATUS_ROW)],
+            stopIfTrue=True,
+            dxf=error_dxf))
     sheet.conditional_formatting.add(
         '{colA}{row1}:{colZ}{rowN}'.format(
             colA=DATA_FIRST_COL,
             row1=CSTATUS_ROW,
             colZ=col_letter,
             rowN=DATA_FIRST_ROW + data_num_rows - 1),
-        FormulaRule([
-            'AND(ISNUMBER(r{rnum}!{colA}{row1}),'
-            'e{rnum}!{colA}{row1}=0,r{rnum}!{colA}{row1}>0)'.format(
-                rnum=resource_num,
-                colA=DATA_FIRST_COL,
-                row1=CSTATUS_ROW)],
-        stopIfTrue=True,
-        fill=required_fill,
-        font=required_font))
+        Rule(
+            type='expression',
+            formula=[
+                'AND(ISNUMBER(r{rnum}!{colA}{row1}),'
+                'e{rnum}!{colA}{row1}=0,r{rnum}!{colA}{row1}>0)'.format(
+                    rnum=resource_num,
+                    colA=DATA_FIRST_COL,
+                    row1=CSTATUS_ROW)],
+            stopIfTrue=True,
+            dxf=required_dxf))